@@ -1,9 +1,14 @@
-from typing import Dict, List, Optional, Union
+import json
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
+import transformers
+from packaging import version
 from transformers import (
     LlamaForCausalLM,
     LlamaTokenizer,
+    LlamaTokenizerFast,
     StoppingCriteria,
     StoppingCriteriaList,
 )
@@ -15,14 +20,29 @@ from functionary.prompt_template import (
 )
 from functionary.prompt_template.base_template import PredefinedFuncTypes
 
+# allow TF32 for the fp32 matmuls that remain (e.g.: in sampling)
+torch.set_float32_matmul_precision("high")
+# StaticCache and model._setup_cache were added in this version
+STATIC_CACHE_MIN_VERSION = version.parse("4.38.0")
+
 
 class StopWordsCriteria(StoppingCriteria):
     def __init__(self, stops=[]):
         StoppingCriteria.__init__(self)
-        self.stops = stops
+        self.stops = [tuple(stop) for stop in stops]
+        # stops of a single token are checked with a set lookup
+        self.single_token_stops = frozenset(
+            stop[0] for stop in self.stops if len(stop) == 1
+        )
+        self.max_stop_length = max((len(stop) for stop in self.stops), default=0)
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
-        inputs = input_ids[0].tolist()
+        if self.max_stop_length == 0:
+            return False
+        # this is called at each step, only the last tokens can match a stop
+        inputs = tuple(input_ids[0, -self.max_stop_length :].tolist())
+        if inputs and inputs[-1] in self.single_token_stops:
+            return True
         for stop in self.stops:
             if len(inputs) >= len(stop) and inputs[-len(stop) :] == stop:
                 return True
@@ -30,12 +50,49 @@ class StopWordsCriteria(StoppingCriteria):
 
 
 def tokenize(message: ChatMessage, tokenizer: LlamaTokenizer, device="cuda:0"):
+    """Tokenize a single message; kept for external callers only.
+    prepare_messages_for_inference tokenizes the whole prompt in a single call"""
     text = str(message)
     return tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids.to(
-        device
+        device, non_blocking=True
     )
 
 
+@lru_cache(maxsize=32)
+def get_prompt_prefix(
+    tokenizer: Any, tools_or_functions_key: str, device="cuda:0"
+) -> Tuple[str, Optional[torch.Tensor]]:
+    """Return the system part of the prompt (schema of functions + system message) and its token_ids.
+    This is cached because generating the schema and tokenizing it is the most expensive CPU work of a request
+    and the functions usually don't change between the turns of a conversation.
+
+    Args:
+        tokenizer (Any): tokenizer
+        tools_or_functions_key (str): tools_or_functions dumped as json, used as the cache key
+        device (str, optional): device of the returned token_ids. Defaults to "cuda:0".
+
+    Returns:
+        Tuple[str, Optional[torch.Tensor]]: the prefix text and its token_ids on device;
+            token_ids is None if the tokenization of the prefix would depend on the text following it
+    """
+    prompt_template = get_prompt_template_from_tokenizer(tokenizer)
+    system_messages = prompt_template.get_system_messages(
+        json.loads(tools_or_functions_key)
+    )
+    prefix = "".join(
+        prompt_template.convert_message_to_prompt(message)
+        for message in system_messages
+    )
+    prefix_ids = tokenizer(prefix).input_ids
+    # the prefix can only be tokenized separately if the next message starts with a special token
+    # that splits the text, check if concatenating the token_ids gives the same result
+    probe = prompt_template.get_additional_tokens()[0]
+    probe_ids = tokenizer.encode(probe, add_special_tokens=False)
+    if tokenizer(prefix + probe).input_ids != prefix_ids + probe_ids:
+        return prefix, None
+    return prefix, torch.tensor([prefix_ids], device=device)
+
+
 def prepare_messages_for_inference(
     *,
     tokenizer: LlamaTokenizer,
@@ -47,22 +104,26 @@ def prepare_messages_for_inference(
 ) -> torch.Tensor:
     prompt_template = get_prompt_template_from_tokenizer(tokenizer)
 
-    dic_messages = [mess.dict() for mess in messages]
+    # model_dump directly, .dict() is deprecated in pydantic v2 and emits a warning per call
+    dic_messages = [mess.model_dump() for mess in messages]
     dic_messages.append({"role": "assistant"})
 
     tools_or_functions = []
     if functions:
-        tools_or_functions = [item.dict() for item in functions]
+        tools_or_functions = [item.model_dump() for item in functions]
     elif tools:
-        tools_or_functions = [item.dict() for item in tools]
+        tools_or_functions = [item.model_dump() for item in tools]
 
     dic_messages = prompt_template.pre_process_messages_before_inference(dic_messages)
 
     # This also checks for code_interpreter and adds python default system message instead
     # default system message
-    final_prompt = prompt_template.get_prompt_from_messages(
-        dic_messages, tools_or_functions=tools_or_functions
+    prefix, prefix_ids = get_prompt_prefix(
+        tokenizer, json.dumps(tools_or_functions, sort_keys=True), device
     )
+    prompt = "".join(
+        prompt_template.convert_message_to_prompt(message) for message in dic_messages
+    ).rstrip()
 
     if (
         prompt_template.version != "v1"
@@ -70,17 +131,28 @@ def prepare_messages_for_inference(
         and tool_choice != "auto"
     ):
         if tool_choice == "none":
-            final_prompt += prompt_template.get_predefined_function_names(
+            prompt += prompt_template.get_predefined_function_names(
                 function_types=PredefinedFuncTypes.no_tool_call
             )[0]
         else:
-            final_prompt += tool_choice.function.name
-        final_prompt += prompt_template.get_stop_token_for_function_parameter(
+            prompt += tool_choice.function.name
+        prompt += prompt_template.get_stop_token_for_function_parameter(
             stage="function"
         )
 
-    input_ids = tokenizer(final_prompt, return_tensors="pt").input_ids
-    input_ids = input_ids.to(device)
+    if prefix_ids is not None and any(
+        prompt.startswith(token) for token in prompt_template.get_additional_tokens()
+    ):
+        # only the messages of this turn need to be tokenized
+        input_ids = tokenizer(
+            prompt, add_special_tokens=False, return_tensors="pt"
+        ).input_ids
+        input_ids = input_ids.to(device, non_blocking=True)
+        return torch.cat([prefix_ids, input_ids], dim=1)
+
+    # tokenize the whole prompt at once (one tokenizer call + one host-to-device copy)
+    input_ids = tokenizer((prefix + prompt).lstrip(), return_tensors="pt").input_ids
+    input_ids = input_ids.to(device, non_blocking=True)
     return input_ids
 
 
@@ -138,6 +210,7 @@ def remove_stop_tokens_from_end(
     return token_ids
 
 
+@torch.inference_mode()
 def generate_message(
     *,
     model: LlamaForCausalLM,
@@ -189,6 +262,77 @@ def generate_message(
     return ChatMessage(**result)
 
 
+def is_static_cache_supported(model: LlamaForCausalLM) -> bool:
+    """Return True if the model can generate with a static KV cache: the cache was added in transformers 4.38
+    (allocated on the attention layers by model._setup_cache) and doesn't support flash_attention_2
+
+    Args:
+        model (LlamaForCausalLM): the model
+
+    Returns:
+        bool: True if model._setup_cache(StaticCache, ...) can be used
+    """
+    return (
+        version.parse(transformers.__version__) >= STATIC_CACHE_MIN_VERSION
+        and callable(getattr(model, "_setup_cache", None))
+        and model.config._attn_implementation != "flash_attention_2"
+    )
+
+
+def check_compile_support(attn_implementation: Optional[str]):
+    """Raise an error if compile_model_for_inference can't speed up decoding:
+    without the static KV cache (transformers>=4.38) the cache grows at every step so the CUDA graph is
+    recorded again at each step, and flash_attention_2 can't be compiled with fullgraph=True
+
+    Args:
+        attn_implementation (Optional[str]): attention implementation of the model
+    """
+    if version.parse(transformers.__version__) < STATIC_CACHE_MIN_VERSION:
+        raise RuntimeError(
+            f"compiling the model requires transformers>=4.38 for the static KV cache, found: {transformers.__version__}"
+        )
+    if attn_implementation == "flash_attention_2":
+        raise ValueError(
+            "compiling the model doesn't support flash_attention_2, use attn_implementation='sdpa'"
+        )
+
+
+def compile_model_for_inference(
+    model: LlamaForCausalLM,
+    tokenizer: LlamaTokenizer,
+    device="cuda:0",
+    num_warmup_steps: int = 2,
+) -> LlamaForCausalLM:
+    """Compile the forward of the model with CUDA graphs and switch generation to a static KV cache,
+    so the shapes stay fixed across decoding steps and the captured graph can be replayed.
+    Requires transformers>=4.38 and a model not using flash_attention_2, see: check_compile_support
+
+    Args:
+        model (LlamaForCausalLM): the model to compile, modified in place
+        tokenizer (LlamaTokenizer): tokenizer used for the warm-up generations
+        device (str, optional): device of the model. Defaults to "cuda:0".
+        num_warmup_steps (int, optional): number of dummy generations to pay the graph recording cost up front. Defaults to 2.
+
+    Returns:
+        LlamaForCausalLM: the compiled model
+    """
+    check_compile_support(model.config._attn_implementation)
+    model.generation_config.cache_implementation = "static"
+    # the captured graphs only fit the calls of model.generate, generate_text_stream calls the original forward
+    model._uncompiled_forward = model.forward
+    model.forward = torch.compile(
+        model.forward, mode="reduce-overhead", fullgraph=True
+    )
+    for _ in range(num_warmup_steps):
+        generate_message(
+            model=model,
+            tokenizer=tokenizer,
+            messages=[ChatMessage(role="user", content="Hi")],
+            device=device,
+        )
+    return model
+
+
 if __name__ == "__main__":
     # First lets create an example messages list with all different types of roles and content.
     functions = [
@@ -239,7 +383,9 @@ if __name__ == "__main__":
     ]
 
     # Now Lets prepare the messages for inference
-    tokenizer = LlamaTokenizer.from_pretrained("musabgultekin/functionary-7b-v1")
+    tokenizer = LlamaTokenizerFast.from_pretrained(
+        "musabgultekin/functionary-7b-v1", legacy=True
+    )
     inputs = prepare_messages_for_inference(
         tokenizer=tokenizer, messages=messages, functions=functions, device="cpu"
     )
@@ -1,35 +1,135 @@
 import gc
-import re
+import inspect
 from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Tuple
 
 import torch
-from transformers import LlamaForCausalLM, LlamaTokenizer
-from transformers.generation.logits_process import (
-    LogitsProcessorList, RepetitionPenaltyLogitsProcessor,
-    TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper)
+from packaging import version
+from transformers import DynamicCache, LlamaForCausalLM, LlamaTokenizer
 
-from functionary.inference import prepare_messages_for_inference
+try:  # StaticCache is only available from transformers 4.38
+    from transformers import StaticCache
+except ImportError:
+    StaticCache = None
+
+try:  # fused top-k/top-p sampling kernel, optional
+    import flashinfer
+    from flashinfer.sampling import top_k_top_p_sampling_from_probs
+
+    # generate_text_stream uses the signature of flashinfer>=0.2: (probs, top_k, top_p) -> samples,
+    # 0.1.x also takes uniform_samples and returns (samples, success)
+    if version.parse(flashinfer.__version__) < version.parse("0.2.0"):
+        top_k_top_p_sampling_from_probs = None
+except ImportError:
+    top_k_top_p_sampling_from_probs = None
+
+from functionary.inference import (is_static_cache_supported,
+                                   prepare_messages_for_inference)
 from functionary.openai_types import ChatMessage, Function, Tool
 from functionary.prompt_template import (PromptTemplate,
                                          get_prompt_template_from_tokenizer)
 
+# finish_reason of the stream
+FINISH_REASON_STOP = "stop"
+FINISH_REASON_LENGTH = "length"
+
+
+def process_logits(
+    logits: torch.Tensor,
+    output_ids: Optional[torch.Tensor],
+    params: torch.Tensor,
+    use_temperature: bool,
+    use_top_p: bool,
+    use_top_k: bool,
+) -> torch.Tensor:
+    """Apply temperature, repetition penalty, top-p and top-k to the logits of the last token.
+    This is the same as the corresponding LogitsProcessors in transformers but written as a single function,
+    so that torch.compile can fuse it into a few kernels instead of one Python dispatch per processor.
+    The values are passed as a tensor so that a new value doesn't trigger a recompilation.
+
+    Args:
+        logits (torch.Tensor): logits of the last token, shape: (vocab_size,)
+        output_ids (Optional[torch.Tensor]): token_ids so far, shape: (1, seq_len); None if repetition_penalty is not used
+        params (torch.Tensor): [temperature, repetition_penalty, top_p, top_k]
+        use_temperature (bool): whether to apply temperature
+        use_top_p (bool): whether to apply top-p filtering
+        use_top_k (bool): whether to apply top-k filtering
 
-def prepare_logits_processor(
-    temperature: float, repetition_penalty: float, top_p: float, top_k: int
-) -> LogitsProcessorList:
-    processor_list = LogitsProcessorList()
-    # TemperatureLogitsWarper doesn't accept 0.0, 1.0 makes it a no-op so we skip two cases.
-    if temperature >= 1e-5 and temperature != 1.0:
-        processor_list.append(TemperatureLogitsWarper(temperature))
-    if repetition_penalty > 1.0:
-        processor_list.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
-    if 1e-8 <= top_p < 1.0:
-        processor_list.append(TopPLogitsWarper(top_p))
-    if top_k > 0:
-        processor_list.append(TopKLogitsWarper(top_k))
-    return processor_list
+    Returns:
+        torch.Tensor: the processed logits, shape: (vocab_size,)
+    """
+    logits = logits.float()
+    if use_temperature:
+        logits = logits / params[0]
+    if output_ids is not None:
+        token_ids = output_ids[0]
+        score = logits.gather(0, token_ids)
+        score = torch.where(score < 0, score * params[1], score / params[1])
+        logits = logits.scatter(0, token_ids, score)
+    if use_top_p or use_top_k:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        to_remove = torch.zeros_like(sorted_logits, dtype=torch.bool)
+        if use_top_p:  # remove the tokens after the cumulative probability reaches top_p, keep at least 1
+            probs = sorted_logits.softmax(dim=-1)
+            to_remove = to_remove | (probs.cumsum(dim=-1) - probs >= params[2])
+        if use_top_k:
+            positions = torch.arange(sorted_logits.shape[-1], device=logits.device)
+            to_remove = to_remove | (positions >= params[3])
+        sorted_logits = sorted_logits.masked_fill(to_remove, float("-inf"))
+        logits = logits.scatter(0, sorted_indices, sorted_logits)
+    return logits
 
 
+# compiled lazily at the first call
+compiled_process_logits = torch.compile(process_logits)
+
+
+def decode_incrementally(
+    tokenizer: LlamaTokenizer,
+    token_ids: List[int],
+    prefix_offset: int,
+    read_offset: int,
+    prefix_text: Optional[str] = None,
+    max_window: int = 16,
+) -> Tuple[str, int, int, Optional[str]]:
+    """Decode only the text of the newly generated token(s) instead of the whole sequence.
+    The tokens in token_ids[prefix_offset: read_offset] are used as a context so that
+    leading spaces of SentencePiece tokens are handled correctly. If the new text ends with an
+    incomplete multi-byte character, nothing is returned and the token is kept for the next call.
+    The decoded window is returned as the prefix_text of the next call, so a step costs a single decode;
+    once the window is longer than max_window tokens it is moved forward and the prefix is decoded again.
+
+    Args:
+        tokenizer (LlamaTokenizer): tokenizer
+        token_ids (List[int]): all token_ids so far (prompt + generated)
+        prefix_offset (int): start index of the context tokens
+        read_offset (int): index of the first token that hasn't been returned as text yet
+        prefix_text (Optional[str], optional): decoded text of token_ids[prefix_offset: read_offset] if known. Defaults to None.
+        max_window (int, optional): maximum number of tokens decoded at each step. Defaults to 16.
+
+    Returns:
+        Tuple[str, int, int, Optional[str]]: new text, updated prefix_offset, updated read_offset, updated prefix_text
+    """
+    if prefix_text is None:
+        prefix_text = tokenizer.decode(
+            token_ids[prefix_offset:read_offset],
+            skip_special_tokens=False,
+            clean_up_tokenization_spaces=False,
+        )
+    new_text = tokenizer.decode(
+        token_ids[prefix_offset:],
+        skip_special_tokens=False,
+        clean_up_tokenization_spaces=False,
+    )
+    if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+        return "", prefix_offset, read_offset, prefix_text
+
+    delta_text = new_text[len(prefix_text) :]
+    if len(token_ids) - prefix_offset > max_window:
+        return delta_text, read_offset, len(token_ids), None
+    return delta_text, prefix_offset, len(token_ids), new_text
+
+
+@torch.inference_mode()
 def generate_text_stream(
     *,
     model: LlamaForCausalLM,
@@ -49,13 +149,36 @@ def generate_text_stream(
     repetition_penalty = float(kwargs.get("repetition_penalty", 1.0))
     top_p = float(kwargs.get("top_p", 1.0))
     top_k = int(kwargs.get("top_k", -1))  # -1 means disable
+    # flushing the CUDA cache synchronizes the device, only do it for offline/batch callers
+    clear_cache = bool(kwargs.get("clear_cache", False))
     _stop_token_ids = list(stop_token_ids)
     if tokenizer.eos_token_id not in _stop_token_ids:
         _stop_token_ids.append(tokenizer.eos_token_id)
 
-    logits_processor = prepare_logits_processor(
-        temperature, repetition_penalty, top_p, top_k
+    is_greedy = temperature < 1e-5 or top_p < 1e-8
+    # top-k/top-p are done by the fused kernel, process_logits only handles temperature & repetition_penalty
+    use_fused_sampling = (
+        top_k_top_p_sampling_from_probs is not None
+        and not is_greedy
+        and torch.device(device).type == "cuda"
     )
+    # temperature 1.0 is a no-op, temperature/top-p/top-k don't change the result of greedy decoding
+    use_temperature = not is_greedy and temperature != 1.0
+    use_top_p = not is_greedy and not use_fused_sampling and top_p < 1.0
+    use_top_k = not is_greedy and not use_fused_sampling and top_k > 0
+    use_repetition_penalty = repetition_penalty > 1.0
+    use_process_logits = (
+        use_temperature or use_top_p or use_top_k or use_repetition_penalty
+    )
+    logits_params = torch.tensor(
+        [temperature, repetition_penalty, top_p, top_k],
+        dtype=torch.float32,
+        device=device,
+    )
+    if torch.device(device).type == "cuda":
+        process_logits_fn = compiled_process_logits
+    else:
+        process_logits_fn = process_logits
     input_ids = prepare_messages_for_inference(
         tokenizer=tokenizer,
         messages=messages,
@@ -63,71 +186,141 @@ def generate_text_stream(
         tools=tools,
         device=device,
     )
-    output_ids = input_ids.clone().detach()
-    past_key_values = None  # KV cached
-    token_ts = None  # next token
+    # preallocated so that the new token is written in place instead of torch.cat at every step
+    prefill_len = input_ids.shape[1]
+    output_ids = torch.empty(
+        (1, prefill_len + max_new_tokens), dtype=torch.long, device=device
+    )
+    output_ids[:, :prefill_len] = input_ids
+    cursor = prefill_len
+    all_token_ids = input_ids[0].tolist()
+    # only a few tokens before the new token are decoded again, see: decode_incrementally
+    read_offset = len(all_token_ids)
+    prefix_offset = max(read_offset - 5, 0)
+    prefix_text = None
+    # stop-token check is done on device so that we don't need to sync before launching the next forward
+    if len(_stop_token_ids) == 1:  # only eos_token_id, a scalar compare is enough
+        stop_ids_ts = torch.as_tensor(_stop_token_ids[0], device=device)
+    else:
+        stop_ids_ts = torch.as_tensor(_stop_token_ids, device=device)
     finish_reason = None
     reach_stop_token = False
-    words = ""
-    for i in range(max_new_tokens):
-        if i == 0:  # prefill
-            out = model(input_ids, use_cache=True)
-        else:  # decoding
-            out = model(
-                input_ids=token_ts,
-                use_cache=True,
-                past_key_values=past_key_values,
-            )
-        logits = out.logits
-        past_key_values = out.past_key_values
-
-        if logits_processor:
-            if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
-            else:
-                tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
-        else:
-            last_token_logits = logits[0, -1, :]
+    max_len = prefill_len + max_new_tokens
+    # with the static cache, the key/values are allocated once on the attention layers and
+    # written in place at cache_position; it is removed from the layers when the stream ends
+    use_static_cache = is_static_cache_supported(model)
+    if use_static_cache:
+        model._setup_cache(StaticCache, max_batch_size=1, max_cache_len=max_len)
+        past_key_values = None
+    else:
+        # passing a Cache object avoids converting the legacy tuple-of-tensors cache at every step
+        past_key_values = DynamicCache()
+    # allocated once; prefill and decoding steps use slices of them so the shapes stay static
+    position_ids = torch.arange(max_len, device=device).unsqueeze(0)
+    attention_mask = torch.ones((1, max_len), dtype=torch.long, device=device)
+    # a forward compiled by compile_model_for_inference is specialized on the calls of model.generate,
+    # running it here would recompile and record the CUDA graphs again at every step
+    model_forward = getattr(model, "_uncompiled_forward", model.forward)
+    # only the logits of the last position are needed, computing them for the whole prompt materializes
+    # (prefill_len, vocab_size) logits. model.forward is called if it can do that (num_logits_to_keep)
+    # or if it does more than lm_head (pretraining_tp > 1); otherwise the decoder and lm_head are called directly
+    keep_last_logits = (
+        "num_logits_to_keep" in inspect.signature(model_forward).parameters
+    )
+    use_model_forward = (
+        keep_last_logits or getattr(model.config, "pretraining_tp", 1) > 1
+    )
+    decoder = model.get_decoder()
+    lm_head = model.get_output_embeddings()
 
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            _, indices = torch.topk(last_token_logits, 2)
-            tokens = [int(index) for index in indices.tolist()]
+    def forward(ids: torch.Tensor, start: int) -> torch.Tensor:
+        end = start + ids.shape[1]
+        model_kwargs = {}
+        if keep_last_logits:
+            model_kwargs["num_logits_to_keep"] = 1
+        if use_static_cache:
+            # the mask covers the whole static cache, the slots after cache_position are hidden by the causal mask
+            model_kwargs["attention_mask"] = attention_mask
+            model_kwargs["cache_position"] = position_ids[0, start:end]
         else:
-            probs = torch.softmax(last_token_logits, dim=-1)
-            indices = torch.multinomial(probs, num_samples=2)
-            tokens = [int(token) for token in indices.tolist()]
-        token_int = tokens[0]
-        token_ts = torch.as_tensor([[token_int]], device=device)
-        current_output_text = tokenizer.decode(
-            output_ids[0].tolist(),
-            skip_special_tokens=False,
-            clean_up_tokenization_spaces=False,
+            # past_key_values is updated in place
+            model_kwargs["attention_mask"] = attention_mask[:, :end]
+            model_kwargs["past_key_values"] = past_key_values
+        inputs = dict(
+            input_ids=ids,
+            position_ids=position_ids[:, start:end],
+            use_cache=True,
+            **model_kwargs,
         )
-        output_ids = torch.cat((output_ids, token_ts), 1)
-        next_output_text = tokenizer.decode(
-            output_ids[0].tolist(),
-            skip_special_tokens=False,
-            clean_up_tokenization_spaces=False,
-        )
-        output = next_output_text[len(current_output_text) :]
-        words += output
-        if token_int in _stop_token_ids:
-            reach_stop_token = True
-            break
-        yield (output, finish_reason)
+        if use_model_forward:
+            logits = model_forward(**inputs).logits[:, -1:, :]
+        else:
+            hidden_states = decoder(**inputs)[0]
+            logits = lm_head(hidden_states[:, -1:, :])
+        # the same upcast as in LlamaForCausalLM.forward, sampling is done on fp32 logits
+        return logits.float()
 
-    # Finish stream event, which contains finish reason
-    if reach_stop_token:
-        finish_reason = "stop"
-    else:
-        finish_reason = "length"
-    yield ("", finish_reason)
+    try:
+        logits = forward(input_ids, 0)  # prefill
+        for i in range(max_new_tokens):
+            if use_process_logits:
+                # output_ids already lives on device, only the repetition penalty reads it
+                last_token_logits = process_logits_fn(
+                    logits[0, -1, :],
+                    output_ids[:, :cursor] if use_repetition_penalty else None,
+                    logits_params,
+                    use_temperature,
+                    use_top_p,
+                    use_top_k,
+                )
+            else:
+                last_token_logits = logits[0, -1, :]
+
+            if is_greedy:
+                indices = last_token_logits.argmax(dim=-1, keepdim=True)
+            elif use_fused_sampling:
+                probs = torch.softmax(last_token_logits.float(), dim=-1)
+                indices = top_k_top_p_sampling_from_probs(
+                    probs.unsqueeze(0), top_k if top_k > 0 else probs.shape[-1], top_p
+                )
+            else:
+                probs = torch.softmax(last_token_logits, dim=-1)
+                indices = torch.multinomial(probs, num_samples=1)
+            token_ts = indices[:1].view(1, 1).long()  # still on device
+            if stop_ids_ts.dim() == 0:
+                is_stop = token_ts == stop_ids_ts
+            else:
+                is_stop = torch.isin(token_ts, stop_ids_ts)
+            output_ids[:, cursor] = token_ts[:, 0]
+            cursor += 1
+            if i + 1 < max_new_tokens:
+                # launch the next forward first, the sync below is overlapped with it
+                logits = forward(token_ts, prefill_len + i)
+            if is_stop.item():
+                reach_stop_token = True
+                break
+            token_int = int(token_ts.item())
+            all_token_ids.append(token_int)
+            output, prefix_offset, read_offset, prefix_text = decode_incrementally(
+                tokenizer, all_token_ids, prefix_offset, read_offset, prefix_text
+            )
+            yield (output, finish_reason)
+
+        # Finish stream event, which contains finish reason
+        if reach_stop_token:
+            finish_reason = FINISH_REASON_STOP
+        else:
+            finish_reason = FINISH_REASON_LENGTH
+        yield ("", finish_reason)
+    finally:
+        if use_static_cache:  # the next generation sets up its own cache
+            model._reset_cache()
 
     # Clean
-    del past_key_values, out
-    gc.collect()
-    torch.cuda.empty_cache()
+    del past_key_values, logits
+    if clear_cache:
+        gc.collect()
+        torch.cuda.empty_cache()
 
 
 def generate_with_check_stop(
@@ -161,7 +354,7 @@ def generate_with_check_stop(
             # change finish_reason=stop if it is stopped if not the finish_reason is still None
             if len(temp_list) > 0:
                 last_item = temp_list[-1]
-                new_item = (last_item[0], last_item[1], "stop")
+                new_item = (last_item[0], last_item[1], FINISH_REASON_STOP)
                 temp_list[-1] = new_item
             break
         if len(temp_list) == max_leng + 1:
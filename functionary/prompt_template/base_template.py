@@ -9,6 +9,8 @@ from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 from functionary.schema import generate_schema_from_functions
 
 SYSTEM_MESSAGE = """A chat between a curious user and an artificial intelligence assistant. The assistant gives helpful, detailed, and polite answers to the user's questions. The assistant calls functions with appropriate input when necessary"""
+# matches the separator between two parameters: `, "`, used at every step of grammar sampling
+PARAM_SEP_PATTERN = re.compile(r',[\s]*"', re.DOTALL)
 PYTHON_RUN_SYS_MSG = "When you send a message containing Python code to python, it will be executed in a stateful Jupyter notebook environment. python will respond with the output of the execution or time out after 60.0 seconds. The drive at '/mnt/data' can be used to save and persist user files."
 
 
@@ -227,8 +229,7 @@ class PromptTemplate:
 
             # Check if the current state can be converted to json, it means the
             # new state is back to "parameter-name" stage
-            pattern = r',[\s]*"'
-            match_res = re.findall(pattern, latest_param_val, re.DOTALL)
+            match_res = PARAM_SEP_PATTERN.findall(latest_param_val)
             if '"' in tokenizer.decode(new_token_id) and len(match_res) > 0:
                 latest_match = match_res[-1]
                 try:
@@ -473,22 +474,18 @@ class PromptTemplate:
         """
         return messages
 
-    def get_prompt_from_messages(
-        self,
-        messages: List[Dict],
-        tools_or_functions: Optional[List[Dict]] = None,
-    ) -> str:
-        """This function is used to get the complete prompt for list of messages
+    def get_system_messages(
+        self, tools_or_functions: Optional[List[Dict]] = None
+    ) -> List[Dict]:
+        """This function is used to get the system messages put at the beginning of the prompt:
+        the schema of functions and the default (or code_interpreter) system message
 
         Args:
-            messages (List[Dict]): List of messages
             tools_or_functions (Optional[List[Dict]], optional): List of tools or functions. Defaults to None.
 
         Returns:
-            str: the prompt for inference/training
+            List[Dict]: the system messages
         """
-        messages_clone = messages.copy()  # To avoid modifying the original list
-
         functions = []
         is_code_interpreter = False
         if tools_or_functions is not None:
@@ -502,13 +499,31 @@ class PromptTemplate:
                 else:
                     functions.append(item)  #  old format
 
-        messages_clone.insert(
-            0, {"role": "system", "content": generate_schema_from_functions(functions)}
-        )
+        system_messages = [
+            {"role": "system", "content": generate_schema_from_functions(functions)}
+        ]
         if is_code_interpreter:
-            messages_clone.insert(1, {"role": "system", "content": PYTHON_RUN_SYS_MSG})
+            system_messages.append({"role": "system", "content": PYTHON_RUN_SYS_MSG})
         else:
-            messages_clone.insert(1, {"role": "system", "content": SYSTEM_MESSAGE})
+            system_messages.append({"role": "system", "content": SYSTEM_MESSAGE})
+        return system_messages
+
+    def get_prompt_from_messages(
+        self,
+        messages: List[Dict],
+        tools_or_functions: Optional[List[Dict]] = None,
+    ) -> str:
+        """This function is used to get the complete prompt for list of messages
+
+        Args:
+            messages (List[Dict]): List of messages
+            tools_or_functions (Optional[List[Dict]], optional): List of tools or functions. Defaults to None.
+
+        Returns:
+            str: the prompt for inference/training
+        """
+        # To avoid modifying the original list
+        messages_clone = self.get_system_messages(tools_or_functions) + messages
 
         full_text = ""
         for message in messages_clone:
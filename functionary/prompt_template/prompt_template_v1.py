@@ -165,14 +165,20 @@ class PromptTemplateV1(PromptTemplate):
             current_state = {
                 "response_type": None,  # the type of current response text (text_response)/function (function_call)
                 "func_name": None,  # if response_type=function, this is the function_name
-                "current_text": "",  # the concatenation of generated tokens so far
+                "current_text": "",  # the generated text needed to detect a function call
             }
-        current_state["current_text"] += delta_text
+        if current_state["response_type"] == "text":
+            # only a suffix is needed to check if the text ends with start_function
+            current_state["current_text"] = (
+                current_state["current_text"] + delta_text
+            )[-len(self.start_function) :]
+        elif current_state["response_type"] is None:
+            current_state["current_text"] += delta_text
         cur_text = current_state["current_text"]
 
         response: Optional[Dict[str, Any]] = None
         if current_state["response_type"] is None:
-            if cur_text.strip().startswith(self.start_function):  # if function_call
+            if cur_text.lstrip().startswith(self.start_function):  # if function_call
                 if cur_text.endswith(":"):
                     f_index = cur_text.find(self.start_function)
                     func_name = cur_text[
@@ -343,7 +343,9 @@ class PromptTemplateV2(PromptTemplate):
                 "skip_until_reach": self.content_token,  # at first we will skip until reach <|content|>
                 "first_time": True,  # if first_time we return an tempty delta with role=assistant
             }
-        current_state["current_text"] += delta_text
+        # current_text is only read while skipping the header (<|from|>...<|content|>) of a response
+        if current_state["skip_until_reach"]:
+            current_state["current_text"] += delta_text
 
         if finish_reason is not None:
             if current_state["response_type"] == "function":
@@ -1,13 +1,28 @@
+import bisect
+import collections
+import contextlib
 import datetime
+import io
+import itertools
 import json
+import multiprocessing
 import os
 import pickle
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import torch
 import transformers
-from torch.utils.data import Dataset
+from numpy.lib.stride_tricks import sliding_window_view
+from torch.utils.data import Dataset, get_worker_info
+
+try:  # faster json parser, optional
+    import orjson
+except ImportError:
+    orjson = None
 
 from functionary.prompt_template import (
     PromptTemplate,
@@ -15,25 +30,18 @@ from functionary.prompt_template import (
 )
 
 
-def get_batch_indices(size: int, batch_size: int) -> List[Tuple[int, int]]:
+def get_batch_indices(size: int, batch_size: int) -> Iterator[Tuple[int, int]]:
     """Split indices into batchs
     Ex, size = 10, batch_size=3 --> split: [[0, 1, 2, ..., 9] --> [0, 1, 2], [3, 4, 5], [6,7,8], [9]]
     Args:
         size (int): total number of indices
-        batch_size (int): _description_
+        batch_size (int): number of indices in a batch
 
     Returns:
-        List[Tuple[int, int]]: _description_
+        Iterator[Tuple[int, int]]: (start, end) of each batch
     """
-    result = []
-    for i in range(size // batch_size + 1):
-        start = i * batch_size
-        end = i * batch_size + batch_size
-        if end > size:
-            end = size
-        if end > start:
-            result.append((start, end))
-    return result
+    for start in range(0, size, batch_size):
+        yield start, min(start + batch_size, size)
 
 
 def get_prefix_assistant_token_ids(
@@ -77,6 +85,21 @@ def get_matching_prefix(
     return None
 
 
+def read_jsonl(path: str) -> List[Dict]:
+    """Read a jsonl file, with orjson if it is installed
+
+    Args:
+        path (str): path to the jsonl file
+
+    Returns:
+        List[Dict]: one item per (non-empty) line
+    """
+    with open(path, "rb") as file:
+        lines = file.read().splitlines()
+    loads = orjson.loads if orjson is not None else json.loads
+    return [loads(line) for line in lines if line.strip()]
+
+
 def read_dataset(data_args, training_args, tokenizer, ds_type):
     """This function is used to read dataset for training
 
@@ -104,10 +127,19 @@ def read_dataset(data_args, training_args, tokenizer, ds_type):
         keep_assistant_prefix = False
 
     if not data_args.packing:
-        with open(data_path, "r") as file:
-            raw_data = [json.loads(line) for line in file]
+        raw_data = None
+        distributed = (
+            torch.distributed.is_available() and torch.distributed.is_initialized()
+        )
+        # only rank 0 parses the file, other ranks receive the parsed data
+        if not distributed or torch.distributed.get_rank() == 0:
+            raw_data = read_jsonl(data_path)
             if data_ratio < 1:
                 raw_data = raw_data[: int(data_ratio * len(raw_data))]
+        if distributed:
+            object_list = [raw_data]
+            torch.distributed.broadcast_object_list(object_list, src=0)
+            raw_data = object_list[0]
         ds = LazyPreprocessDataset(
             raw_data, tokenizer, keep_assistant_prefix=keep_assistant_prefix
         )
@@ -129,15 +161,11 @@ def read_dataset(data_args, training_args, tokenizer, ds_type):
         )
         torch.distributed.barrier()
     else:  # rank 0 process the data and save to cached_folder
-        if not os.path.exists(training_args.output_dir):
-            os.mkdir(training_args.output_dir)
-        if not os.path.exists(cached_folder):
-            os.mkdir(cached_folder)
+        os.makedirs(cached_folder, exist_ok=True)
 
-        with open(data_path, "r") as file:
-            raw_train_data = [json.loads(line) for line in file]
-            if data_ratio < 1:
-                raw_train_data = raw_train_data[: int(data_ratio * len(raw_train_data))]
+        raw_train_data = read_jsonl(data_path)
+        if data_ratio < 1:
+            raw_train_data = raw_train_data[: int(data_ratio * len(raw_train_data))]
 
         print(f"{ds_type} size: : {len(raw_train_data)}")
         # ignore_cached=True to ignore the cached if exist, rank 0 will always process the data
@@ -149,21 +177,24 @@ def read_dataset(data_args, training_args, tokenizer, ds_type):
             keep_assistant_prefix=keep_assistant_prefix,
             use_flash_attention=True,
             pack_length=pack_length,
+            num_workers=data_args.preprocessing_num_workers,
         )
         print(f"process: {local_rank} finish processing data")
         world_size = int(os.environ.get("WORLD_SIZE", 1))
         if world_size > 1:
             torch.distributed.barrier()  # allow other ranks to execute
 
-    # All ranks will read the processed data from cached_path created by rank 0
-    ds = PackedDataset(
-        None,
-        tokenizer,
-        cached_folder=cached_folder,
-        ignore_cached=False,
-        use_flash_attention=True,
-        pack_length=pack_length,
-    )
+    # Other ranks will read the processed data from cached_folder created by rank 0,
+    # rank 0 already has it in memory so no need to load it again
+    if training_args.local_rank > 0:
+        ds = PackedDataset(
+            None,
+            tokenizer,
+            cached_folder=cached_folder,
+            ignore_cached=False,
+            use_flash_attention=True,
+            pack_length=pack_length,
+        )
     if local_rank == 0:
         ds.stat()  #  print some statistics about the dataset
     return ds
@@ -213,8 +244,8 @@ def get_masked_labels(
     *,
     input_token_ids: List[int],
     tokenizer: Any,
-    assistant_prefix_tokens: List[List[int]],
-    assistant_stop_tokens: List[int],
+    assistant_prefix_tokens: Sequence[Sequence[int]],
+    assistant_stop_tokens: Sequence[int],
     keep_assistant_prefix: bool = False,
     verbose: bool = False,
 ):
@@ -224,8 +255,8 @@ def get_masked_labels(
     Args:
         input_token_ids (List[int]): input_token_ids
         tokenizer (Any): _description_
-        assistant_prefix_tokens (List[List[int]]): _description_
-        assistant_stop_tokens (List[int]): _description_
+        assistant_prefix_tokens (Sequence[Sequence[int]]): token_ids of assistant prefixes
+        assistant_stop_tokens (Sequence[int]): token_ids of stop tokens
         keep_assistant_prefix (bool, optional): _description_. Defaults to False.
         verbose (bool, optional): _description_. Defaults to False.
 
@@ -234,63 +265,59 @@ def get_masked_labels(
     """
     # first we initialize labels with all positions as -100,
     # then we will fill in positions where role=assistant as we only include these in computing the loss
-    labels = [-100 for _ in range(len(input_token_ids))]
-    start = 0
+    token_ids = np.asarray(input_token_ids, dtype=np.int64)
+    total_input_leng = len(token_ids)
+    labels = np.full(total_input_leng, -100, dtype=np.int64)
     # now we will unmask labels by positions that was from assistant
     # we will find the chunks: "<endtoken>assistant ...(<end_of_function>|<end_of_assistant>) from input_token_ids
     # and unmask: this part: "...(<end_of_function>|<end_of_assistant>"
-    # find token_ids of: "<endtoken>assistant"
-    # prefix_token_ids = get_prefix_assistant_token_ids(tokenizer)
-    # if verbose:
-    #    print("prefix_token_ids: ", prefix_token_ids)
+    # find all positions that start with: "<endtoken>assistant", if more than one prefix match
+    # at the same position, the first prefix in assistant_prefix_tokens is used
+    prefix_positions = {}  # position --> length of the matched prefix
+    for prefix in assistant_prefix_tokens:
+        if len(prefix) > total_input_leng:
+            continue
+        windows = sliding_window_view(token_ids, len(prefix))
+        for position in np.flatnonzero((windows == prefix).all(axis=1)).tolist():
+            prefix_positions.setdefault(position, len(prefix))
+    # positions of <end_of_function> or <end_of_assistant>, sorted
+    stop_positions = np.flatnonzero(np.isin(token_ids, assistant_stop_tokens))
+
+    positions = sorted(prefix_positions)
+    # unmask from this position until reach <end_of_function> or <end_of_assistant>
+    if keep_assistant_prefix:  # unmask prefix of assistant
+        start_masked_indices = positions
+    else:
+        start_masked_indices = [
+            position + prefix_positions[position] for position in positions
+        ]
+    # for all the matches at once: index in stop_positions of the first stop token from start_masked_index
+    stop_indices = np.searchsorted(stop_positions, start_masked_indices).tolist()
+    stop_positions = stop_positions.tolist()
+
     index = 0
-    total_input_leng = len(input_token_ids)
-    while index < total_input_leng:
-        # finding the index that start with: "<endtoken>assistant" --> we will unmask labels from this position
-        matched_prefix = get_matching_prefix(
-            assistant_prefix_tokens, input_token_ids[index:]
-        )
-        if matched_prefix is not None:
-            end_index = -1
-            # unmask until reach <end_of_function> or <end_of_assistant>
-            start_masked_index = index + len(matched_prefix)
-            if keep_assistant_prefix:  # unmask prefix of assistant
-                start_masked_index = index
-
-            for i in range(start_masked_index, total_input_leng):
-                tok_id = input_token_ids[i]
-                if tok_id in assistant_stop_tokens:  # check if this is end of turn
-                    labels[i] = input_token_ids[i]  # unmask labels at this position
-                    end_index = i
-                    break
-                else:
-                    labels[i] = input_token_ids[i]  # unmask labels at this position
-
-            if verbose:
-                print("------------------------")
-                start = start_masked_index  # index + len(matched_prefix)
-                chunk_ids = (
-                    input_token_ids[start : end_index + 1]
-                    if end_index > -1
-                    else input_token_ids[start:]
-                )
-                print("chunk_ids: ", chunk_ids)
-                print(
-                    "longer chunk: ",
-                    input_token_ids[index : end_index + 1]
-                    if end_index > 1
-                    else input_token_ids[index:],
-                )
-                print(f"chunk:{tokenizer.decode(chunk_ids)}")
-                print("-------------------")
-            if (
-                end_index == -1
-            ):  # if at the end, cannot find EndToken.assistant or EndToken.function_call --> this data point was truncated
-                break
-            index = end_index
-        else:
-            index += 1
-    return labels
+    for position, start_masked_index, stop_index in zip(
+        positions, start_masked_indices, stop_indices
+    ):
+        if position < index:  # inside the chunk that was unmasked
+            continue
+        end_index = stop_positions[stop_index] if stop_index < len(stop_positions) else -1
+        chunk_end = end_index + 1 if end_index > -1 else total_input_leng
+        labels[start_masked_index:chunk_end] = token_ids[start_masked_index:chunk_end]
+
+        if verbose:
+            print("------------------------")
+            chunk_ids = input_token_ids[start_masked_index:chunk_end]
+            print("chunk_ids: ", chunk_ids)
+            print("longer chunk: ", input_token_ids[position:chunk_end])
+            print(f"chunk:{tokenizer.decode(chunk_ids)}")
+            print("-------------------")
+        if (
+            end_index == -1
+        ):  # if at the end, cannot find EndToken.assistant or EndToken.function_call --> this data point was truncated
+            break
+        index = end_index
+    return labels.tolist()
 
 
 def get_assistant_stop_token_ids(prompt_template, tokenizer: Any) -> Dict[str, int]:
@@ -315,6 +342,32 @@ def get_assistant_stop_token_ids(prompt_template, tokenizer: Any) -> Dict[str, i
     return result
 
 
+@lru_cache(maxsize=8)
+def get_assistant_token_ids(
+    tokenizer: Any,
+) -> Tuple[Tuple[Tuple[int, ...], ...], Tuple[int, ...]]:
+    """Return the token_ids of assistant prefixes and stop tokens used for masking labels.
+    This is cached per tokenizer so the prefixes/stop tokens are only encoded once,
+    instead of once per call of prepare_training_inputs (once per data point in LazyPreprocessDataset)
+
+    Args:
+        tokenizer (Any): tokenizer in transformers
+
+    Returns:
+        Tuple[Tuple[Tuple[int, ...], ...], Tuple[int, ...]]: (token_ids of assistant prefixes, token_ids of stop tokens),
+            frozen as tuples so the cached value can't be mutated by callers
+    """
+    prompt_template = get_prompt_template_from_tokenizer(tokenizer)
+    assistant_prefix_tokens = tuple(
+        tuple(token_ids)
+        for token_ids in get_prefix_assistant_token_ids(prompt_template, tokenizer)
+    )
+    assistant_stop_token_ids = tuple(
+        get_assistant_stop_token_ids(prompt_template, tokenizer)
+    )
+    return assistant_prefix_tokens, assistant_stop_token_ids
+
+
 def prepare_training_inputs_batch(
     *,
     batch_messages: Dict[str, List],
@@ -342,10 +395,10 @@ def prepare_training_inputs_batch(
             final_prompt: the final prompt to be used,
             inputs: a dictionary containing: input_ids, attention_mask, labels. This will be used in model.forward(**inputs)
     """
-    # a dictionary mapping from end_token_ --> end_token
     prompt_template = get_prompt_template_from_tokenizer(tokenizer)
-    assistant_stop_token_ids = get_assistant_stop_token_ids(prompt_template, tokenizer)
-    assistant_prefix_tokens = get_prefix_assistant_token_ids(prompt_template, tokenizer)
+    assistant_prefix_tokens, assistant_stop_token_ids = get_assistant_token_ids(
+        tokenizer
+    )
 
     prompt_str_list = []
     for messages in batch_messages:
@@ -386,105 +439,223 @@ def prepare_training_inputs_batch(
         == len(batch_messages)
     )
 
+    keys = ["labels", "input_ids", "attention_mask"]
+    batch_values = {key: input_dic[key] for key in keys}
+    if return_tensor:
+        for key in keys:
+            rows = input_dic[key]
+            if len(set(len(row) for row in rows)) <= 1:
+                # all rows have the same length (padded): convert the whole batch at once, rows are views
+                batch_values[key] = torch.from_numpy(np.asarray(rows, dtype=np.int64))
+            else:
+                batch_values[key] = [
+                    torch.from_numpy(np.asarray(row, dtype=np.int64)) for row in rows
+                ]
+
     batch_inputs = []
     for i in range(len(input_dic["input_ids"])):
         inputs = {}
-        for key in ["labels", "input_ids", "attention_mask"]:
-            inputs[key] = input_dic[key][i]
-            if return_tensor:
-                inputs[key] = torch.tensor(inputs[key])
+        for key in keys:
+            inputs[key] = batch_values[key][i]
         batch_inputs.append(inputs)
 
     return dict(batch_prompts=prompt_str_list, batch_inputs=batch_inputs)
 
 
-def map_raw_data_to_input_dic(
+# tokenizer of the current worker process in map_raw_data_to_input_dic, set by _init_worker
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer: Any):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _prepare_training_inputs_batch_in_worker(
+    batch_messages: List[Dict], padding: str, keep_assistant_prefix: bool
+) -> List[Dict]:
+    return prepare_training_inputs_batch(
+        batch_messages=batch_messages,
+        tokenizer=_worker_tokenizer,
+        padding=padding,
+        return_tensor=False,
+        keep_assistant_prefix=keep_assistant_prefix,
+    )["batch_inputs"]
+
+
+def iterate_raw_data_to_input_dic(
     *,
     raw_data: List[Dict],
     tokenizer: Any,
     padding: str,
     batch_size: int = 5000,
     keep_assistant_prefix: bool = False,
-) -> List[Dict]:
-    """This function is used to map list of raw_data to list of processed data points for packing
+    num_workers: int = 1,
+) -> Iterator[List[Dict]]:
+    """This function is used to map raw_data to processed data points batch by batch,
+    so the caller can write each batch out instead of keeping all data points in memory.
+    Data points whose labels are all -100 are removed
     Args:
         raw_data (List[Dict]): data points from train_file/evaluation_file
         tokenizer (Any): _description_
         padding (str): _description_
         batch_size (int, optional): _description_. Defaults to 5000.
         keep_assistant_prefix (bool, optional): if we unmask assistant prefix in computing loss. Defaults to False.
+        num_workers (int, optional): number of processes used to prepare the batches, batches are processed in parallel
+            if > 1. Defaults to 1.
 
     Returns:
-        List[Dict]: _description_
+        Iterator[List[Dict]]: the valid processed data points of each batch, in the order of raw_data
     """
     invalid_count = 0
     data_size = len(raw_data)
-    data_points = []
     t1 = datetime.datetime.now()
-    for start, end in get_batch_indices(data_size, batch_size):
-        batch_result = prepare_training_inputs_batch(
-            batch_messages=raw_data[start:end],
-            tokenizer=tokenizer,
-            padding=padding,
-            return_tensor=False,
-            keep_assistant_prefix=keep_assistant_prefix,
+    batch_indices = list(get_batch_indices(data_size, batch_size))
+    if num_workers > 1 and len(batch_indices) > 1:
+        # the tokenizer is sent once to each worker instead of being pickled with every batch
+        # use spawn as forking after the (Rust) tokenizer was used can deadlock
+        executor = ProcessPoolExecutor(
+            max_workers=min(num_workers, len(batch_indices)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(tokenizer,),
         )
 
-        assert len(batch_result["batch_inputs"]) == len(raw_data[start:end])
-        for item in batch_result["batch_inputs"]:
-            if is_valid_labels(item["labels"]):
-                data_points.append(item)
-            else:
-                invalid_count += 1
+        def submit(start: int, end: int):
+            return executor.submit(
+                _prepare_training_inputs_batch_in_worker,
+                raw_data[start:end],
+                padding,
+                keep_assistant_prefix,
+            )
 
-        t2 = datetime.datetime.now()
-        avg_time = (t2 - t1).total_seconds() / len(data_points)
-        remaining_time = avg_time * (data_size - len(data_points))
-        print(
-            f"{len(data_points)}/{data_size}, avg_time per 1000 data points: {avg_time * 1000}, remaining time: {remaining_time}"
+        def get_batch_results():
+            # results are collected in order, so the order of data points is the same as serial processing
+            # only 2 batches per worker are in flight, so finished batches don't pile up in memory
+            futures = collections.deque()
+            pending = iter(batch_indices)
+            for start, end in itertools.islice(pending, 2 * num_workers):
+                futures.append(submit(start, end))
+            while futures:
+                batch_inputs = futures.popleft().result()
+                for start, end in itertools.islice(pending, 1):
+                    futures.append(submit(start, end))
+                yield batch_inputs
+
+        batch_results = get_batch_results()
+    else:
+        executor = None
+        batch_results = (
+            prepare_training_inputs_batch(
+                batch_messages=raw_data[start:end],
+                tokenizer=tokenizer,
+                padding=padding,
+                return_tensor=False,
+                keep_assistant_prefix=keep_assistant_prefix,
+            )["batch_inputs"]
+            for start, end in batch_indices
         )
+
+    try:
+        for (start, end), batch_inputs in zip(batch_indices, batch_results):
+            assert len(batch_inputs) == end - start
+            valid_inputs = [
+                item for item in batch_inputs if is_valid_labels(item["labels"])
+            ]
+            invalid_count += len(batch_inputs) - len(valid_inputs)
+            yield valid_inputs
+
+            # time is averaged over all processed data points (including the invalid ones)
+            t2 = datetime.datetime.now()
+            avg_time = (t2 - t1).total_seconds() / end
+            remaining_time = avg_time * (data_size - end)
+            print(
+                f"{end}/{data_size}, avg_time per 1000 data points: {avg_time * 1000}, remaining time: {remaining_time}"
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
     if invalid_count > 0:
         print(
             f"*****WARNING: invalid data points: {invalid_count} because of labels=-100 all the time"
         )
-    assert len(data_points) == data_size - invalid_count
+
+
+def map_raw_data_to_input_dic(
+    *,
+    raw_data: List[Dict],
+    tokenizer: Any,
+    padding: str,
+    batch_size: int = 5000,
+    keep_assistant_prefix: bool = False,
+    num_workers: int = 1,
+) -> List[Dict]:
+    """This function is used to map list of raw_data to list of processed data points for packing
+    Args:
+        raw_data (List[Dict]): data points from train_file/evaluation_file
+        tokenizer (Any): _description_
+        padding (str): _description_
+        batch_size (int, optional): _description_. Defaults to 5000.
+        keep_assistant_prefix (bool, optional): if we unmask assistant prefix in computing loss. Defaults to False.
+        num_workers (int, optional): number of processes used to prepare the batches, batches are processed in parallel
+            if > 1. Defaults to 1.
+
+    Returns:
+        List[Dict]: _description_
+    """
+    data_points = []
+    for batch_inputs in iterate_raw_data_to_input_dic(
+        raw_data=raw_data,
+        tokenizer=tokenizer,
+        padding=padding,
+        batch_size=batch_size,
+        keep_assistant_prefix=keep_assistant_prefix,
+        num_workers=num_workers,
+    ):
+        data_points.extend(batch_inputs)
     return data_points
 
 
 def merge_data_points_by_length(lengths: List[int], max_length: int) -> List[List[int]]:
     """given lengths of data points, we merge them into groups such that the sum of lengths
     in each group is less than max_length. This is known as: https://en.wikipedia.org/wiki/Bin_packing_problem
-    Here is the greedy algorithm
+    Here we use Best-Fit-Decreasing: data points are visited from the longest to the shortest,
+    each is put in the group with the smallest remaining space that can contain it (or a new group).
+    This gives much fuller groups (so fewer training steps) than merging consecutive data points.
     Args:
-        lengths (List[int]): _description_
-        max_length (int): _description_
+        lengths (List[int]): lengths of data points
+        max_length (int): maximum sum of lengths in a group
 
     Returns:
         _type_: groups of indices: [[index1, index2, ...], [], ...]
     """
-    items = [{"length": length, "index": i} for i, length in enumerate(lengths)]
-    items = sorted(items, key=lambda x: x["index"])
-    merges = []
-    current_sum = 0
-    current_list = []
-    for i in range(len(items)):
-        cur_length = items[i]["length"]
-        if cur_length + current_sum <= max_length:
-            current_sum += items[i]["length"]
-            current_list.append(i)
+    groups = []
+    # remaining space --> indices of groups with this remaining space
+    groups_by_space = {}
+    spaces = []  # sorted list of remaining spaces in groups_by_space
+    for index in np.argsort(-np.asarray(lengths), kind="stable").tolist():
+        length = lengths[index]
+        pos = bisect.bisect_left(spaces, length)
+        if pos < len(spaces):  # best fit: the smallest remaining space >= length
+            space = spaces[pos]
+            group_index = groups_by_space[space].pop()
+            if not groups_by_space[space]:
+                del groups_by_space[space]
+                spaces.pop(pos)
         else:
-            merges.append(current_list)
-            current_list = [i]
-            current_sum = cur_length
+            group_index = len(groups)
+            groups.append([])
+            space = max_length
+        groups[group_index].append(index)
 
-    if len(current_list) > 0:
-        merges.append(current_list)
-
-    result = []
-    for merge in merges:
-        sub_items = [items[index]["index"] for index in merge]
-        result.append(sub_items)
-    return result
+        remaining = space - length
+        if remaining > 0:
+            if remaining not in groups_by_space:
+                groups_by_space[remaining] = []
+                bisect.insort(spaces, remaining)
+            groups_by_space[remaining].append(group_index)
+    # keep the original order of data points inside each group
+    return [sorted(group) for group in groups]
 
 
 def get_causal_mask(length: int, m_value: float) -> torch.tensor:
@@ -497,10 +668,7 @@ def get_causal_mask(length: int, m_value: float) -> torch.tensor:
     Returns:
         torch.tensor: _description_
     """
-    mask = torch.full((length, length), m_value)
-    mask_cond = torch.arange(mask.size(-1))
-    mask.masked_fill_(mask_cond < (mask_cond + 1).view(mask.size(-1), 1), 0)
-    return mask
+    return torch.triu(torch.full((length, length), m_value), diagonal=1)
 
 
 def create_mask_from_lengths(
@@ -519,24 +687,29 @@ def create_mask_from_lengths(
     result = torch.full((max_length, max_length), m_value)
     acc_leng = 0
     for length in lengths:
-        # mask for a data point with length
-        x = get_causal_mask(length, m_value)
-        result[acc_leng : acc_leng + length, acc_leng : acc_leng + length] = x
+        # the block of a data point is already filled with m_value, zero its lower triangle in place
+        result[acc_leng : acc_leng + length, acc_leng : acc_leng + length].triu_(
+            diagonal=1
+        )
         acc_leng += length
 
-    pad_length = max_length - sum(lengths)
+    pad_length = max_length - acc_leng
     if pad_length > 0:
         result[-pad_length:, :] = 0
         result[:, -pad_length:] = m_value
     return result
 
 
-def pack_data_points(data_points: List[Dict], tokenizer: Any, pack_length: int) -> Dict:
+def pack_data_points(
+    data_points: List[Dict], pad_token_id: int, padding_side: str, pack_length: int
+) -> Dict:
     """This method is used to pack multiple data points into a single data point used for Normal Attention (vs FlashAttention)
 
     Args:
         data_points (List[Dict]): _description_
-        tokenizer (Any): _description_
+        pad_token_id (int): token_id used for padding
+        padding_side (str): "right" or "left"
+        pack_length (int): length of the packed data point
 
     Returns:
         Dict: _description_
@@ -555,11 +728,11 @@ def pack_data_points(data_points: List[Dict], tokenizer: Any, pack_length: int)
     attention_mask = create_mask_from_lengths(lengths, pack_length, float("-inf"))
     pad_leng = pack_length - len(input_ids)  # padding to model_max_length
 
-    if tokenizer.padding_side == "right":
-        input_ids = input_ids + [tokenizer.pad_token_id for _ in range(pad_leng)]
+    if padding_side == "right":
+        input_ids = input_ids + [pad_token_id for _ in range(pad_leng)]
         label_ids = label_ids + [-100 for _ in range(pad_leng)]
     else:
-        input_ids = [tokenizer.pad_token_id for _ in range(pad_leng)] + input_ids
+        input_ids = [pad_token_id for _ in range(pad_leng)] + input_ids
         label_ids = [-100 for _ in range(pad_leng)] + label_ids
 
     assert len(input_ids) == len(label_ids) == attention_mask.size(0) == pack_length
@@ -574,7 +747,7 @@ def pack_data_points(data_points: List[Dict], tokenizer: Any, pack_length: int)
 
 
 def pack_data_points_FA(
-    data_points: List[Dict], tokenizer: Any, pack_length: int
+    data_points: List[Dict], pad_token_id: int, padding_side: str, pack_length: int
 ) -> Dict:
     """This method is used to pack multiple data_points into a single data point usable for Flash Attention
 
@@ -583,16 +756,21 @@ def pack_data_points_FA(
     input2= {"input_ids": token_ids2, "labels": label_ids2}
     --> output would be:
 
-    output = {"input_ids": token_ids1 + token_ids + [pad_token, ...]} padding to tokenizer.model_max_length
+    output = {"input_ids": token_ids1 + token_ids + [pad_token, ...]} padding to pack_length
     output["labels"] =  label_ids1 + label_ids2 + [-100, -100, ...]
     output["attention_mask"] = [1,...,1, 2,...,2, 0...0]
         number of 1s = len(input_ids1)
         number of 2s = len(input_ids2)
         number of 0s = padding_length
+    output["position_ids"] = [0, 1, ..., len(input_ids1) - 1, 0, 1, ..., len(input_ids2) - 1, 0...0]
+    The attention_mask holds segment ids instead of a N x N mask, the monkey-patched flash attention uses it
+    to attend within each data point; position_ids restart at each data point as if it was not packed
 
     Args:
         data_points (List[Dict]): List of data points to pack: [{"input_ids": xxx, "labels": xxx}, ...]
-        tokenizer (Any): _description_
+        pad_token_id (int): token_id used for padding
+        padding_side (str): "right" or "left"
+        pack_length (int): length of the packed data point
 
     Returns:
         Dict: final single data point
@@ -601,6 +779,7 @@ def pack_data_points_FA(
     lengths = []
     label_ids = []
     attention_mask = []
+    position_ids = []
 
     for index, item in enumerate(data_points):
         input_ids += item["input_ids"]
@@ -610,25 +789,27 @@ def pack_data_points_FA(
         label_ids += labels
         lengths.append(len(item["input_ids"]))
         attention_mask += [index + 1 for _ in range(len(item["input_ids"]))]
+        position_ids += list(range(len(item["input_ids"])))
 
     pad_leng = pack_length - len(input_ids)  # padding to model_max_length
 
-    if tokenizer.padding_side == "right":
-        input_ids = input_ids + [tokenizer.pad_token_id for _ in range(pad_leng)]
+    if padding_side == "right":
+        input_ids = input_ids + [pad_token_id for _ in range(pad_leng)]
         label_ids = label_ids + [-100 for _ in range(pad_leng)]
         attention_mask = attention_mask + [0 for _ in range(pad_leng)]
+        position_ids = position_ids + [0 for _ in range(pad_leng)]
     else:
-        input_ids = [tokenizer.pad_token_id for _ in range(pad_leng)] + input_ids
+        input_ids = [pad_token_id for _ in range(pad_leng)] + input_ids
         label_ids = [-100 for _ in range(pad_leng)] + label_ids
         attention_mask = [0 for _ in range(pad_leng)] + attention_mask
+        position_ids = [0 for _ in range(pad_leng)] + position_ids
 
     assert len(input_ids) == len(label_ids) == len(attention_mask) == pack_length
     return {
         "input_ids": torch.tensor(input_ids),
         "labels": torch.tensor(label_ids),
-        "attention_mask": torch.tensor(
-            attention_mask
-        ),  # unsqueeze <-- because the shape is: B x 1 x N x N
+        "attention_mask": torch.tensor(attention_mask),  # segment ids, not B x 1 x N x N
+        "position_ids": torch.tensor(position_ids),
     }
 
 
@@ -640,19 +821,10 @@ def is_valid_labels(labels: Union[List[int], torch.Tensor]) -> bool:
     Returns:
         bool: _description_
     """
-    if type(labels) is list:
-        non_mask_count = 0
-        for label in labels:
-            if label != -100:
-                non_mask_count += 1
-
-        if non_mask_count == 0:
-            return False
-        return True
-    else:
-        if sum(labels + 100) == 0:
-            return False
-        return True
+    if isinstance(labels, torch.Tensor):
+        return bool(labels.ne(-100).any())
+    # stop at the first unmasked label
+    return any(label != -100 for label in labels)
 
 
 def remove_invalid_label_items(data_points: List[Dict]) -> List[Dict]:
@@ -688,6 +860,10 @@ class CachedDataset(Dataset):
         if cached_folder is not None and not ignore_cached:
             data_path = self.get_data_point_path(cached_folder)
             if os.path.exists(data_path):
+                if not os.path.exists(self.get_metainfo_path(cached_folder)):
+                    print(
+                        f"meta_info.json not found in: {cached_folder}, load the data points only"
+                    )
                 print(f"cached found, load from cached: {cached_folder}")
                 self.load(cached_folder)
                 self.load_from_cache = True
@@ -706,24 +882,28 @@ class CachedDataset(Dataset):
 
     def load(self, folder: str):
         t1 = datetime.datetime.now()
-        with open(self.get_data_point_path(folder), "rb") as file:
-            self.data_points = pickle.load(file)
+        self.data_points = self.load_data_points(self.get_data_point_path(folder))
         t2 = datetime.datetime.now()
         print("time for loading cached data: ", (t2 - t1).total_seconds())
 
     def get_data_point_path(self, folder: str) -> str:
         return os.path.join(folder, "data_points.pkl")
 
+    def load_data_points(self, path: str) -> Any:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def dump_data_points(self, path: str):
+        with open(path, "wb") as file:
+            pickle.dump(self.data_points, file, protocol=pickle.HIGHEST_PROTOCOL)
+
     def get_metainfo_path(self, folder: str) -> str:
         return os.path.join(folder, "meta_info.json")
 
     def dump(self, folder: str):
         t1 = datetime.datetime.now()
-        if not os.path.exists(folder):
-            os.mkdir(folder)
-
-        with open(self.get_data_point_path(folder), "wb") as file:
-            pickle.dump(self.data_points, file)
+        os.makedirs(folder, exist_ok=True)
+        self.dump_data_points(self.get_data_point_path(folder))
 
         with open(self.get_metainfo_path(folder), "w") as f:
             f.write(json.dumps(self.create_meta_info()))
@@ -801,7 +981,9 @@ class LazyPreprocessDataset(Dataset):
             "labels": ret["inputs"]["labels"],
             "attention_mask": ret["inputs"]["attention_mask"],
         }
-        self.cached_data_dict[i] = ret
+        if get_worker_info() is None:
+            # each (persistent) dataloader worker would keep its own copy, only cache in the main process
+            self.cached_data_dict[i] = ret
         return ret
 
 
@@ -818,43 +1000,147 @@ class PackedDataset(CachedDataset):
         keep_assistant_prefix: bool = False,
         use_flash_attention: bool = True,
         pack_length: Optional[int] = None,
+        num_workers: int = 1,
     ):
         super().__init__(tokenizer, cached_folder, ignore_cached)
         self.use_flash_attention = use_flash_attention
         self.pack_length = pack_length if pack_length else tokenizer.model_max_length
         print("self.pack_length: ", self.pack_length)
+        # only these are used after preprocessing, the tokenizer is released at the end so it isn't
+        # copied to the dataloader workers with the dataset
+        self.pad_token_id = tokenizer.pad_token_id
+        self.padding_side = tokenizer.padding_side
+        self.model_max_length = tokenizer.model_max_length
         if not self.load_from_cache:
-            self.data_points = map_raw_data_to_input_dic(
+            batches = iterate_raw_data_to_input_dic(
                 raw_data=raw_data,
                 tokenizer=tokenizer,
                 padding="do_not_pad",
                 batch_size=batch_size,
                 keep_assistant_prefix=keep_assistant_prefix,
+                num_workers=num_workers,
             )
-            self.update_packing_info()
             if cached_folder is not None:
                 print(f"dump data to cached: {cached_folder}")
-                self.dump(cached_folder)
-        else:  # update packing
-            self.update_packing_info()
+            self.write_data_points(batches, cached_folder)
+        self.update_packing_info()
+        self.tokenizer = None
+
+    def write_data_points(
+        self, batches: Iterator[List[Dict]], folder: Optional[str] = None
+    ):
+        """Write input_ids/labels of the processed data points batch by batch, so only one batch of python lists
+        is in memory at a time. If folder is given, they are written to the cache in folder and memory-mapped,
+        otherwise they are kept in flat arrays in memory.
+        Flat arrays are used instead of lists of python ints: DataLoader workers are forked and reading a python
+        object updates its refcount, so each worker would end up copying the pages of the whole dataset,
+        whereas the pages of the arrays stay shared
+
+        Args:
+            batches (Iterator[List[Dict]]): processed data points, batch by batch: [{"input_ids": xxx, "labels": xxx}, ...]
+            folder (Optional[str], optional): cached folder. Defaults to None.
+        """
+        t1 = datetime.datetime.now()
+        self.lengths = []
+        with contextlib.ExitStack() as stack:
+            files = {}
+            for key in ["input_ids", "labels"]:
+                if folder is not None:
+                    os.makedirs(folder, exist_ok=True)
+                    path = self.get_array_path(folder, key) + ".tmp"
+                    files[key] = stack.enter_context(open(path, "wb"))
+                else:
+                    files[key] = io.BytesIO()
+            for batch in batches:
+                self.lengths.extend(len(item["input_ids"]) for item in batch)
+                for key, file in files.items():
+                    values = itertools.chain.from_iterable(item[key] for item in batch)
+                    file.write(np.fromiter(values, dtype=np.int32).tobytes())
+            if folder is None:
+                for key, file in files.items():
+                    setattr(self, key, np.frombuffer(file.getvalue(), dtype=np.int32))
+                return
+
+        for key in files:
+            path = self.get_array_path(folder, key)
+            os.replace(path + ".tmp", path)
+        self.dump_lengths(self.get_data_point_path(folder))
+        with open(self.get_metainfo_path(folder), "w") as f:
+            f.write(json.dumps(self.create_meta_info()))
+        t2 = datetime.datetime.now()
+        print("time for dumping data: ", (t2 - t1).total_seconds())
+        self.load(folder)
 
     def update_packing_info(self):
-        self.lengths = [len(item["input_ids"]) for item in self.data_points]
+        self.offsets = np.cumsum([0] + self.lengths)
         self.groups = merge_data_points_by_length(self.lengths, self.pack_length)
 
+    def get_data_point(self, i) -> Dict[str, List[int]]:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {
+            "input_ids": self.input_ids[start:end].tolist(),
+            "labels": self.labels[start:end].tolist(),
+        }
+
+    def create_meta_info(self):
+        # the data points are kept in flat arrays, not in self.data_points
+        return {
+            "max_length": self.model_max_length,
+            "size": len(self.lengths),
+        }
+
+    def get_data_point_path(self, folder: str) -> str:
+        # lengths of the data points, written last so the cache is only loaded if it is complete
+        return os.path.join(folder, "lengths.npy")
+
+    def get_array_path(self, folder: str, key: str) -> str:
+        return os.path.join(folder, f"{key}.bin")
+
+    def load(self, folder: str):
+        t1 = datetime.datetime.now()
+        self.lengths = np.load(self.get_data_point_path(folder)).tolist()
+        # memory-mapped: pages are read on demand and shared by the dataloader workers through the page cache
+        for key in ["input_ids", "labels"]:
+            setattr(
+                self,
+                key,
+                np.memmap(self.get_array_path(folder, key), dtype=np.int32, mode="r"),
+            )
+        t2 = datetime.datetime.now()
+        print("time for loading cached data: ", (t2 - t1).total_seconds())
+
+    def dump_data_points(self, path: str):
+        folder = os.path.dirname(path)
+        # write to a temporary file and rename it, the arrays might be memory-mapped from the destination
+        for key in ["input_ids", "labels"]:
+            array_path = self.get_array_path(folder, key)
+            getattr(self, key).tofile(array_path + ".tmp")
+            os.replace(array_path + ".tmp", array_path)
+        self.dump_lengths(path)
+
+    def dump_lengths(self, path: str):
+        # written last, as the cache is only loaded if this file exists
+        with open(path + ".tmp", "wb") as file:
+            np.save(file, np.asarray(self.lengths, dtype=np.int64))
+        os.replace(path + ".tmp", path)
+
     def __len__(self):
         return len(self.groups)
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         group = self.groups[i]
-        group_data_points = [self.data_points[index] for index in group]
+        group_data_points = [self.get_data_point(index) for index in group]
         if not self.use_flash_attention:
-            return pack_data_points(group_data_points, self.tokenizer, self.pack_length)
-        return pack_data_points_FA(group_data_points, self.tokenizer, self.pack_length)
+            return pack_data_points(
+                group_data_points, self.pad_token_id, self.padding_side, self.pack_length
+            )
+        return pack_data_points_FA(
+            group_data_points, self.pad_token_id, self.padding_side, self.pack_length
+        )
 
     def stat(self):
         print(
-            f"number of original data points:{len(self.data_points)}; packed to: {len(self.groups)} data points"
+            f"number of original data points:{len(self.lengths)}; packed to: {len(self.groups)} data points"
         )
         original_avg_length = sum(self.lengths) / len(self.lengths)
         packed_lengths = []
@@ -2,20 +2,48 @@ import sys
 import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
-from transformers import AutoModelForCausalLM, LlamaTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from functionary.prompt_template import get_prompt_template_by_version
 from peft import PeftModel
 import torch
 import typer
 import transformers
 import math 
+from typing import Optional
+from safetensors import safe_open
+
+
+def get_saved_vocab_size(checkpoint: str) -> Optional[int]:
+    """Return the number of rows of embed_tokens saved in the adapter checkpoint (modules_to_save),
+    checkpoints trained before the vocab was padded to a multiple of 64 have len(tokenizer) rows
+
+    Args:
+        checkpoint (str): folder of the adapter checkpoint
+
+    Returns:
+        Optional[int]: the vocab size of the saved embeddings, None if the checkpoint doesn't contain them
+    """
+    safetensors_path = os.path.join(checkpoint, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        with safe_open(safetensors_path, framework="pt") as f:
+            for key in f.keys():
+                if "embed_tokens" in key:
+                    return f.get_slice(key).get_shape()[0]
+        return None
+    bin_path = os.path.join(checkpoint, "adapter_model.bin")
+    if os.path.exists(bin_path):
+        state_dict = torch.load(bin_path, map_location="cpu")
+        for key, value in state_dict.items():
+            if "embed_tokens" in key:
+                return value.shape[0]
+    return None
 
 
 def merge_weight(save_folder: str, pretrained_path: str, checkpoint: str, model_max_length: int, prompt_template_version: str):
     print("save to: ", save_folder)
     print("pretrained: ", pretrained_path)
     print("checkpoint: ", checkpoint)
-    tokenizer = LlamaTokenizer.from_pretrained(pretrained_path, legacy=True, model_max_length=model_max_length)
+    tokenizer = AutoTokenizer.from_pretrained(pretrained_path, legacy=True, model_max_length=model_max_length, use_fast=True)
     tokenizer.pad_token = tokenizer.eos_token
     
     prompt_template = get_prompt_template_by_version(prompt_template_version)
@@ -39,10 +67,14 @@ def merge_weight(save_folder: str, pretrained_path: str, checkpoint: str, model_
         device_map="auto",
         trust_remote_code=True,
         torch_dtype=torch.bfloat16,
-        use_flash_attention_2=True,
+        attn_implementation="flash_attention_2",
     )
     print("model = ", model)
-    model.resize_token_embeddings(len(tokenizer))
+    # same vocab size as the embeddings saved in the checkpoint
+    vocab_size = get_saved_vocab_size(checkpoint) or len(tokenizer)
+    print("vocab size: ", vocab_size)
+    if model.get_input_embeddings().weight.size(0) != vocab_size:
+        model.resize_token_embeddings(vocab_size)
 
     lora_model = PeftModel.from_pretrained(model, checkpoint, torch_dtype=torch.float16)
     lora_model = lora_model.merge_and_unload()
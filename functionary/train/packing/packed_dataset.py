@@ -51,6 +51,7 @@ def pack_data_points_FA(
     lengths = []
     label_ids = []
     attention_mask = []
+    position_ids = []
 
     for index, item in enumerate(data_points):
         input_ids += item["input_ids"]
@@ -60,24 +61,27 @@ def pack_data_points_FA(
         label_ids += labels
         lengths.append(len(item["input_ids"]))
         attention_mask += [index + 1 for _ in range(len(item["input_ids"]))]
+        # position_ids restart at each data point as if it was not packed
+        position_ids += list(range(len(item["input_ids"])))
 
     pad_leng = pack_length - len(input_ids)  # padding to model_max_length
     if tokenizer.padding_side == "right":
         input_ids = input_ids + [tokenizer.pad_token_id for _ in range(pad_leng)]
         label_ids = label_ids + [-100 for _ in range(pad_leng)]
         attention_mask = attention_mask + [0 for _ in range(pad_leng)]
+        position_ids = position_ids + [0 for _ in range(pad_leng)]
     else:
         input_ids = [tokenizer.pad_token_id for _ in range(pad_leng)] + input_ids
         label_ids = [-100 for _ in range(pad_leng)] + label_ids
         attention_mask = [0 for _ in range(pad_leng)] + attention_mask
+        position_ids = [0 for _ in range(pad_leng)] + position_ids
 
     assert len(input_ids) == len(label_ids) == len(attention_mask) == pack_length
     return {
         "input_ids": torch.tensor(input_ids),
         "labels": torch.tensor(label_ids),
-        "attention_mask": torch.tensor(
-            attention_mask
-        ),  # unsqueeze <-- because the shape is: B x 1 x N x N
+        "attention_mask": torch.tensor(attention_mask),  # segment ids, not B x 1 x N x N
+        "position_ids": torch.tensor(position_ids),
     }
 
 
@@ -4,15 +4,16 @@ import os
 import pathlib
 import sys
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import torch
+import torch._dynamo
 import torch.distributed
+import torch.nn.functional as F
 import transformers
-from torch.nn import CrossEntropyLoss
 from torch.utils.data import DataLoader
-from transformers import AutoConfig, AutoTokenizer, Trainer
+from transformers import AutoConfig, AutoTokenizer, Trainer, default_data_collator
 
 #  sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
 from functionary.prompt_template import PromptTemplate, get_prompt_template_by_version
@@ -54,12 +55,33 @@ class DataArguments:
             "help": "pack_length used to pack data points, default = 0 --> = model_max_length"
         },
     )
+    preprocessing_num_workers: int = field(
+        default=1,
+        metadata={
+            "help": "number of processes used to preprocess the data for packing"
+        },
+    )
 
 
 @dataclass
 class TrainingArguments(transformers.TrainingArguments):
     cache_dir: Optional[str] = field(default=None)
-    optim: str = field(default="adamw_torch")
+    optim: str = field(default="adamw_torch_fused")
+    # None: enabled if the GPU supports it (Ampere+), see __post_init__
+    bf16: Optional[bool] = field(default=None)
+    tf32: Optional[bool] = field(default=None)
+    gradient_checkpointing: bool = field(default=True)
+    # non-reentrant checkpointing works with flash attention and doesn't require inputs with grad
+    gradient_checkpointing_kwargs: Optional[dict] = field(
+        default_factory=lambda: {"use_reentrant": False}
+    )
+    torch_compile: bool = field(
+        default=False,
+        metadata={
+            "help": "Compile the model with torch.compile (not verified with FSDP/DeepSpeed or the packing monkey-patch), "
+            "use it with --dataloader_drop_last True: a partial last batch would trigger a recompilation"
+        },
+    )
     model_max_length: int = field(
         default=4096,
         metadata={
@@ -76,6 +98,58 @@ class TrainingArguments(transformers.TrainingArguments):
     prompt_template_version: str = field(
         default="v2", metadata={"help": "choose prompt template to use for training"}
     )
+    eval_accumulation_steps: Optional[int] = field(
+        default=16,
+        metadata={
+            "help": "Number of eval steps to accumulate the predictions on GPU before moving them to CPU"
+        },
+    )
+    # with --dataloader_num_workers > 0 the batches are loaded in background processes,
+    # kept alive across epochs, so they overlap with the training step
+    dataloader_persistent_workers: bool = field(default=True)
+
+    def __post_init__(self):
+        # bf16 and tf32 raise on CPU and GPUs older than Ampere, only enable them by default if supported
+        is_ampere = (
+            torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+        )
+        if self.bf16 is None:
+            self.bf16 = is_ampere and not self.fp16
+        if self.tf32 is None and is_ampere:
+            self.tf32 = True
+        # persistent workers require at least one worker process
+        if self.dataloader_num_workers == 0:
+            self.dataloader_persistent_workers = False
+        else:
+            # the workers are forked from the main process where the (Rust) tokenizer has already been used,
+            # its thread pool is not fork-safe
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        super().__post_init__()
+
+
+class StaticShapeTrainer(Trainer):
+    """Trainer marking the sequence dimension of the input tensors as static when the model is compiled,
+    so torch.compile specializes the graph for model_max_length instead of compiling a dynamic-shape graph"""
+
+    def mark_sequence_dim_static(self, inputs: Dict[str, Any]):
+        if not self.args.torch_compile:
+            return
+        for value in inputs.values():
+            if isinstance(value, torch.Tensor) and value.dim() >= 2:
+                # (batch_size, seq_len) or the (batch_size, 1, seq_len, seq_len) mask of packing without flash attention
+                dims = [1] if value.dim() == 2 else [value.dim() - 2, value.dim() - 1]
+                for dim in dims:
+                    torch._dynamo.mark_static(value, dim)
+
+    def training_step(self, model, inputs):
+        self.mark_sequence_dim_static(inputs)
+        return super().training_step(model, inputs)
+
+    def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None):
+        self.mark_sequence_dim_static(inputs)
+        return super().prediction_step(
+            model, inputs, prediction_loss_only, ignore_keys=ignore_keys
+        )
 
 
 def trainer_save_model_safe(trainer: transformers.Trainer):
@@ -103,16 +177,19 @@ def initialize_tokenizer(
         padding_side = "right"
 
     # note that must set legacy=True, read more: https://github.com/huggingface/transformers/issues/25176
+    # the fast (Rust) tokenizer gives the same token_ids and tokenizes batches of prompts in parallel
     tokenizer = AutoTokenizer.from_pretrained(
         model_name_or_path,
         cache_dir=cache_dir,
         model_max_length=model_max_length,
         padding_side=padding_side,
         legacy=True,
+        use_fast=True,
     )
 
     # Add special tokens
-    tokenizer.pad_token = tokenizer.eos_token
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
     added_tokens = prompt_template.get_additional_tokens()
     special_tokens = {"additional_special_tokens": added_tokens}
     num_new_tokens = tokenizer.add_special_tokens(special_tokens)
@@ -121,21 +198,28 @@ def initialize_tokenizer(
     tokenizer.chat_template = prompt_template.get_chat_template_jinja()
     print("tokenizer: ", tokenizer)
 
-    # Resize embedding
-    model.resize_token_embeddings(len(tokenizer))
+    # Resize embedding, the vocab is padded to a multiple of 64
+    # so that the matmul of lm_head has tensor-core aligned shapes
+    vocab_size = (len(tokenizer) + 63) // 64 * 64
+    if model.get_input_embeddings().weight.size(0) != vocab_size:
+        # resizing copies the whole embedding matrices, skip it if the checkpoint already has this size
+        model.resize_token_embeddings(vocab_size)
     if num_new_tokens > 0:
-        input_embeddings = model.get_input_embeddings().weight.data
-        output_embeddings = model.get_output_embeddings().weight.data
-
-        input_embeddings_avg = input_embeddings[:-num_new_tokens].mean(
-            dim=0, keepdim=True
-        )
-        output_embeddings_avg = output_embeddings[:-num_new_tokens].mean(
-            dim=0, keepdim=True
-        )
-
-        input_embeddings[-num_new_tokens:] = input_embeddings_avg
-        output_embeddings[-num_new_tokens:] = output_embeddings_avg
+        # the new tokens are followed by the padding rows, so they are not the last rows of the embeddings
+        num_old_tokens = len(tokenizer) - num_new_tokens
+        for embeddings in (
+            model.get_input_embeddings().weight.data,
+            model.get_output_embeddings().weight.data,
+        ):
+            embeddings_avg = torch.empty(
+                1, embeddings.size(1), dtype=embeddings.dtype, device=embeddings.device
+            )
+            torch.mean(
+                embeddings[:num_old_tokens], dim=0, keepdim=True, out=embeddings_avg
+            )
+            embeddings[num_old_tokens : len(tokenizer)].copy_(
+                embeddings_avg.expand(num_new_tokens, -1)
+            )
 
     return tokenizer
 
@@ -254,9 +338,10 @@ def train():
         torch_dtype=compute_dtype,
         config=config,
         cache_dir=training_args.cache_dir,
-        use_flash_attention_2=True,
+        attn_implementation="flash_attention_2",  # use_flash_attention_2 is replaced by this from version: 4.36.0
     )
     model.config.use_cache = False
+    print_rank0("attention implementation: ", model.config._attn_implementation)
     # Activate computing load balancing loss iin MixtralForCausalLM
     if hasattr(model.config, "output_router_logits"):
         setattr(model.config, "output_router_logits", True)
@@ -313,72 +398,74 @@ def train():
 
     def preprocess_logits_for_metrics(logits, labels):
         """Preprocesses the logits during evaluation by computing the greedy token predictions for
-        accuracy calculation and loss values for perplexity calculation. Both pred_ids and loss are
-        of shape (batch_size x seq_len)"""
-        pred_ids = torch.argmax(logits, dim=-1)
-
-        loss_fn = CrossEntropyLoss(reduction="none")
-        shift_logits = logits[..., :-1, :].contiguous()
-        shift_labels = labels[..., 1:].contiguous()
-        shift_logits = shift_logits.view(-1, len(tokenizer))
-        shift_labels = shift_labels.view(-1)
-        loss = loss_fn(shift_logits, shift_labels)
-        loss = torch.mean(loss.view(logits.shape[0], -1), dim=-1)
+        accuracy calculation and loss values for perplexity calculation. pred_ids are the predictions
+        of the next tokens: (batch_size x (seq_len - 1)), loss is of shape (batch_size)"""
+        # the argmax reads the same logits as the loss, right before it
+        # token ids fit in int32, this halves the predictions gathered across eval steps
+        pred_ids = logits[..., :-1, :].argmax(dim=-1).to(torch.int32)
+
+        # shift the labels instead of the logits: slicing the logits makes reshape copy the whole
+        # (batch_size x seq_len x vocab) tensor, the loss of ignored labels (-100) is 0
+        shift_labels = F.pad(labels[..., 1:], (0, 1), value=-100)
+        loss = F.cross_entropy(
+            logits.reshape(-1, logits.size(-1)),
+            shift_labels.reshape(-1),
+            reduction="none",
+        )
+        # the last position has no next token
+        loss = loss.view(logits.size(0), -1)[:, :-1].mean(dim=-1)
 
         return pred_ids, loss
 
     def compute_metrics(eval_preds):
         """Computes next-token accuracy and perplexity metrics for evaluation"""
-        predictions = eval_preds.predictions[0][:, :-1]
+        # predictions are already shifted in preprocess_logits_for_metrics
+        predictions = eval_preds.predictions[0]
         labels = eval_preds.label_ids[:, 1:]
 
-        acc_count = 0
-        total_num = 0
-        dic = {token_id: {"acc": 0, "total": 0} for token_id in id2token}
-        for pred, label in zip(
-            predictions.flatten().tolist(), labels.flatten().tolist()
-        ):
-            if label != -100:
-                if label == pred:
-                    acc_count += 1
-                total_num += 1
-            if label in dic:
-                dic[label]["total"] += 1
-                if label == pred:
-                    dic[label]["acc"] += 1
+        mask = labels != -100
+        correct = predictions == labels
+        total_num = int(mask.sum())
+        acc_count = int((correct & mask).sum())
 
         # Calculate perplexity
-        loss = eval_preds.predictions[1].tolist()
-        loss = sum(loss) / len(loss)
-        perplexity = math.exp(loss)
-
-        metrics = {"accuracy": acc_count / total_num, "perplexity": perplexity}
-        for token_id in dic:
-            token = id2token[token_id]
-            total_num = dic[token_id]["total"]
+        perplexity = math.exp(float(np.mean(eval_preds.predictions[1])))
+
+        metrics = {"accuracy": acc_count / max(total_num, 1), "perplexity": perplexity}
+        for token_id, token in id2token.items():
+            token_mask = labels == token_id
+            total_num = int(token_mask.sum())
             acc = -1
             if total_num > 0:
-                acc = dic[token_id]["acc"] / total_num
+                acc = int((correct & token_mask).sum()) / total_num
             metrics[f"accuracy_{token}"] = acc
             metrics[f"accuracy_total_num_{token}"] = total_num
 
         return metrics
 
+    if training_args.torch_compile:
+        # leave room for the recompilations of the train and eval modes
+        torch._dynamo.config.cache_size_limit = 64
+
     if training_args.do_eval:
-        trainer = Trainer(
+        trainer = StaticShapeTrainer(
             model=model,
             tokenizer=tokenizer,
             args=training_args,
+            # data points are already padded to the same length, batches are a torch.stack per key
+            # instead of the default DataCollatorWithPadding (tokenizer.pad converts tensors back to lists)
+            data_collator=default_data_collator,
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
             compute_metrics=compute_metrics,
             preprocess_logits_for_metrics=preprocess_logits_for_metrics,
         )
     else:
-        trainer = Trainer(
+        trainer = StaticShapeTrainer(
             model=model,
             tokenizer=tokenizer,
             args=training_args,
+            data_collator=default_data_collator,
             train_dataset=train_dataset,
         )
 
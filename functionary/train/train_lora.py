@@ -2,14 +2,14 @@ import json
 import math
 import os
 import pathlib
-import random
 import sys
 from dataclasses import dataclass, field
 from typing import Any, Dict, List, Optional
 
+import numpy as np
 import torch
 import torch.distributed
-from torch.nn import CrossEntropyLoss
+import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
@@ -20,11 +20,11 @@ from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 from transformers import (
     AutoConfig,
+    AutoTokenizer,
     BitsAndBytesConfig,
-    LlamaTokenizer,
-    LlamaTokenizerFast,
     Trainer,
     deepspeed,
+    default_data_collator,
 )
 
 from functionary.prompt_template import get_prompt_template_by_version
@@ -60,6 +60,12 @@ class DataArguments:
     packing: bool = field(
         default=False, metadata={"help": "Whether use packing or not"}
     )
+    preprocessing_num_workers: int = field(
+        default=1,
+        metadata={
+            "help": "number of processes used to preprocess the data for packing"
+        },
+    )
 
 
 @dataclass
@@ -85,6 +91,25 @@ class TrainingArguments(transformers.TrainingArguments):
     prompt_template_version: str = field(
         default="v2", metadata={"help": "choose prompt template to use for training"}
     )
+    eval_accumulation_steps: Optional[int] = field(
+        default=16,
+        metadata={
+            "help": "Number of eval steps to accumulate the predictions on GPU before moving them to CPU"
+        },
+    )
+    # with --dataloader_num_workers > 0 the batches are loaded in background processes,
+    # kept alive across epochs, so they overlap with the training step
+    dataloader_persistent_workers: bool = field(default=True)
+
+    def __post_init__(self):
+        # persistent workers require at least one worker process
+        if self.dataloader_num_workers == 0:
+            self.dataloader_persistent_workers = False
+        else:
+            # the workers are forked from the main process where the (Rust) tokenizer has already been used,
+            # its thread pool is not fork-safe
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        super().__post_init__()
 
 
 @dataclass
@@ -276,19 +301,22 @@ def prepare_model_for_training(
 
 
 # Borrowed from: https://github.com/lm-sys/FastChat/blob/main/fastchat/train/train_lora.py#L68
-def maybe_zero_3(param):
+def maybe_zero_3(param, keep=True):
+    # copy=True makes exactly one host copy: .cpu().clone() copied GPU tensors twice
+    # the gather is collective so every rank enters it, but only the rank saving the weights (keep=True)
+    # copies them to cpu, the other ranks return None
     if hasattr(param, "ds_id"):
         assert param.ds_status == ZeroParamStatus.NOT_AVAILABLE
         with zero.GatheredParameters([param]):
-            param = param.data.detach().cpu().clone()
+            param = param.data.detach().to("cpu", copy=True) if keep else None
     else:
-        param = param.detach().cpu().clone()
+        param = param.detach().to("cpu", copy=True) if keep else None
     return param
 
 
 # Borrowed from peft.utils.get_peft_model_state_dict
 # Borrowed from: https://github.com/lm-sys/FastChat/blob/main/fastchat/train/train_lora.py#L68
-def get_peft_state_maybe_zero_3(named_params, bias):
+def get_peft_state_maybe_zero_3(named_params, bias, keep=True):
     if bias == "none":
         to_return = {k: t for k, t in named_params if "lora_" in k}
     elif bias == "all":
@@ -309,7 +337,9 @@ def get_peft_state_maybe_zero_3(named_params, bias):
                 to_return[bias_name] = t
     else:
         raise NotImplementedError
-    to_return = {k: maybe_zero_3(v) for k, v in to_return.items()}
+    to_return = {k: maybe_zero_3(v, keep) for k, v in to_return.items()}
+    if not keep:
+        return {}
     return to_return
 
 
@@ -375,15 +405,17 @@ def initialize_tokenizer(
 ):
     """Initialize tokenizer and add special tokens, resizing vocab and embedding"""
     # note that must set legacy=True, read more: https://github.com/huggingface/transformers/issues/25176
-    tokenizer = LlamaTokenizerFast.from_pretrained(
+    tokenizer = AutoTokenizer.from_pretrained(
         model_name_or_path,
         cache_dir=cache_dir,
         model_max_length=model_max_length,
         legacy=True,
+        use_fast=True,
     )
 
     # Add special tokens
-    tokenizer.pad_token = tokenizer.unk_token
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.unk_token
     prompt_template = prompt_template = get_prompt_template_by_version(
         prompt_template_version
     )
@@ -392,21 +424,28 @@ def initialize_tokenizer(
     }
     num_new_tokens = tokenizer.add_special_tokens(special_tokens)
 
-    # Resize embedding
-    model.resize_token_embeddings(len(tokenizer))
+    # Resize embedding, the vocab is padded to a multiple of 64
+    # so that the matmul of lm_head has tensor-core aligned shapes
+    vocab_size = (len(tokenizer) + 63) // 64 * 64
+    if model.get_input_embeddings().weight.size(0) != vocab_size:
+        # resizing copies the whole embedding matrices, skip it if the checkpoint already has this size
+        model.resize_token_embeddings(vocab_size)
     if num_new_tokens > 0:
-        input_embeddings = model.get_input_embeddings().weight.data
-        output_embeddings = model.get_output_embeddings().weight.data
-
-        input_embeddings_avg = input_embeddings[:-num_new_tokens].mean(
-            dim=0, keepdim=True
-        )
-        output_embeddings_avg = output_embeddings[:-num_new_tokens].mean(
-            dim=0, keepdim=True
-        )
-
-        input_embeddings[-num_new_tokens:] = input_embeddings_avg
-        output_embeddings[-num_new_tokens:] = output_embeddings_avg
+        # the new tokens are followed by the padding rows, so they are not the last rows of the embeddings
+        num_old_tokens = len(tokenizer) - num_new_tokens
+        for embeddings in (
+            model.get_input_embeddings().weight.data,
+            model.get_output_embeddings().weight.data,
+        ):
+            embeddings_avg = torch.empty(
+                1, embeddings.size(1), dtype=embeddings.dtype, device=embeddings.device
+            )
+            torch.mean(
+                embeddings[:num_old_tokens], dim=0, keepdim=True, out=embeddings_avg
+            )
+            embeddings[num_old_tokens : len(tokenizer)].copy_(
+                embeddings_avg.expand(num_new_tokens, -1)
+            )
 
     return tokenizer
 
@@ -460,48 +499,49 @@ def train():
 
     def preprocess_logits_for_metrics(logits, labels):
         """Preprocesses the logits during evaluation by computing the greedy token predictions for
-        accuracy calculation and loss values for perplexity calculation. Both pred_ids and loss are
-        of shape (batch_size x seq_len)"""
-        pred_ids = torch.argmax(logits, dim=-1)
-
-        loss_fn = CrossEntropyLoss(reduction="none")
-        shift_logits = logits[..., :-1, :].contiguous()
-        shift_labels = labels[..., 1:].contiguous()
-        shift_logits = shift_logits.view(-1, len(tokenizer))
-        shift_labels = shift_labels.view(-1)
-        loss = loss_fn(shift_logits, shift_labels)
-        loss = torch.mean(loss.view(logits.shape[0], -1), dim=-1)
+        accuracy calculation and loss values for perplexity calculation. pred_ids are the predictions
+        of the next tokens: (batch_size x (seq_len - 1)), loss is of shape (batch_size)"""
+        # the argmax reads the same logits as the loss, right before it
+        # token ids fit in int32, this halves the predictions gathered across eval steps
+        pred_ids = logits[..., :-1, :].argmax(dim=-1).to(torch.int32)
+
+        # shift the labels instead of the logits: slicing the logits makes reshape copy the whole
+        # (batch_size x seq_len x vocab) tensor, the loss of ignored labels (-100) is 0
+        shift_labels = F.pad(labels[..., 1:], (0, 1), value=-100)
+        loss = F.cross_entropy(
+            logits.reshape(-1, logits.size(-1)),
+            shift_labels.reshape(-1),
+            reduction="none",
+        )
+        # the last position has no next token
+        loss = loss.view(logits.size(0), -1)[:, :-1].mean(dim=-1)
 
         return pred_ids, loss
 
     def compute_metrics(eval_preds):
         """Computes next-token accuracy and perplexity metrics for evaluation"""
-        predictions = eval_preds.predictions[0][:, :-1]
+        # predictions are already shifted in preprocess_logits_for_metrics
+        predictions = eval_preds.predictions[0]
         labels = eval_preds.label_ids[:, 1:]
 
         # Calculate accuracy
-        acc_count = 0
-        total_num = 0
-        for pred, label in zip(
-            predictions.flatten().tolist(), labels.flatten().tolist()
-        ):
-            if label != -100:
-                if label == pred:
-                    acc_count += 1
-                total_num += 1
+        mask = labels != -100
+        total_num = int(mask.sum())
+        acc_count = int(((predictions == labels) & mask).sum())
 
         # Calculate perplexity
-        loss = eval_preds.predictions[1].tolist()
-        loss = sum(loss) / len(loss)
-        perplexity = math.exp(loss)
+        perplexity = math.exp(float(np.mean(eval_preds.predictions[1])))
 
-        return {"accuracy": acc_count / total_num, "perplexity": perplexity}
+        return {"accuracy": acc_count / max(total_num, 1), "perplexity": perplexity}
 
     if training_args.do_eval:
         trainer = Trainer(
             model=model,
             tokenizer=tokenizer,
             args=training_args,
+            # data points are already padded to the same length, batches are a torch.stack per key
+            # instead of the default DataCollatorWithPadding (tokenizer.pad converts tensors back to lists)
+            data_collator=default_data_collator,
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
             compute_metrics=compute_metrics,
@@ -512,6 +552,7 @@ def train():
             model=model,
             tokenizer=tokenizer,
             args=training_args,
+            data_collator=default_data_collator,
             train_dataset=train_dataset,
         )
 
@@ -521,21 +562,18 @@ def train():
         trainer.train()
     trainer.save_state()
 
-    # check if zero3 mode enabled
-    if deepspeed.is_deepspeed_zero3_enabled():
-        # use deepspeed engine internal function to gather state dict
-        # state_dict_zero3 contains whole parameters of base and lora adapters
-        # we will not extract lora parameters since peft save_pretrained will do that
-        # https://github.com/huggingface/peft/blob/3714aa2fff158fdfa637b2b65952580801d890b2/src/peft/peft_model.py#L125
-        # https://github.com/huggingface/peft/blob/3714aa2fff158fdfa637b2b65952580801d890b2/src/peft/utils/save_and_load.py#L19
-        state_dict_zero3 = trainer.model_wrapped._zero3_consolidated_16bit_state_dict()
-        if training_args.local_rank == 0:
-            state_dict = state_dict_zero3
-    else:
-        # in other mode we use original code from fastchat team, to make sure our change is minimum
-        state_dict = get_peft_state_maybe_zero_3(
-            model.named_parameters(), lora_args.lora_bias
-        )
+    # walk the parameters and gather (in zero3 mode) + copy to cpu one at a time only the ones saved by peft:
+    # lora adapters (and biases) and the retrained embeddings (modules_to_save), instead of consolidating
+    # the state_dict of the whole model including the frozen base weights
+    # all the ranks take part in the gather, only rank 0 (which saves) keeps the cpu copies
+    keep = training_args.local_rank == 0
+    named_params = list(model.named_parameters())
+    state_dict = get_peft_state_maybe_zero_3(named_params, lora_args.lora_bias, keep)
+    for k, t in named_params:
+        if "modules_to_save" in k:
+            t = maybe_zero_3(t, keep)
+            if keep:
+                state_dict[k] = t
 
     if training_args.local_rank == 0:
         model.save_pretrained(training_args.output_dir, state_dict=state_dict)
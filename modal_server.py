@@ -23,7 +23,7 @@ LOADIN8BIT = False
 def get_model():
     # this is lazy should be using the modal model class
     import torch
-    from transformers import LlamaForCausalLM, LlamaTokenizer
+    from transformers import LlamaForCausalLM, LlamaTokenizerFast
 
     model = LlamaForCausalLM.from_pretrained(
         MODEL,
@@ -32,7 +32,7 @@ def get_model():
         torch_dtype=torch.float16,
         load_in_8bit=LOADIN8BIT,
     )
-    tokenizer = LlamaTokenizer.from_pretrained(MODEL, use_fast=False)
+    tokenizer = LlamaTokenizerFast.from_pretrained(MODEL, legacy=True)
     return model, tokenizer
 
 
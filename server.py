@@ -1,5 +1,7 @@
 import argparse
+import asyncio
 import json
+import threading
 import uuid
 from typing import Union
 
@@ -7,22 +9,36 @@ import torch
 import uvicorn
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse, StreamingResponse
-from transformers import (AutoModelForCausalLM, LlamaForCausalLM,
-                          LlamaTokenizerFast)
+from starlette.background import BackgroundTask
+from transformers import (AutoModelForCausalLM, BitsAndBytesConfig,
+                          LlamaForCausalLM, LlamaTokenizerFast)
+from transformers.utils import is_flash_attn_2_available
 
-from functionary.inference import generate_message
+from functionary.inference import (check_compile_support,
+                                   compile_model_for_inference,
+                                   generate_message)
 from functionary.inference_stream import generate_stream
 from functionary.openai_types import (ChatCompletion, ChatCompletionChunk,
                                       ChatInput, Choice, StreamChoice)
 
 app = FastAPI(title="Functionary API")
+# generation runs in worker threads so it doesn't block the event loop, but the model (and its static
+# KV cache when compiled) is shared, so only one generation runs at a time.
+# For concurrent requests batched on the GPU use server_vllm.py
+model_lock = threading.Lock()
+
+
+def generate_message_locked(**kwargs):
+    with model_lock:
+        return generate_message(**kwargs)
 
 
 @app.post("/v1/chat/completions")
 async def chat_endpoint(chat_input: ChatInput):
     request_id = str(uuid.uuid4())
     if not chat_input.stream:
-        response_message = generate_message(
+        response_message = await asyncio.to_thread(
+            generate_message_locked,
             messages=chat_input.messages,
             functions=chat_input.functions,
             tools=chat_input.tools,
@@ -49,16 +65,30 @@ async def chat_endpoint(chat_input: ChatInput):
             tokenizer=tokenizer,
         )
 
+        # StreamingResponse iterates this (sync) generator in a worker thread
         def get_response_stream():
-            for response in response_generator:
-                chunk = StreamChoice(**response)
-                result = ChatCompletionChunk(id=request_id, choices=[chunk])
-                chunk_dic = result.dict(exclude_unset=True)
-                chunk_data = json.dumps(chunk_dic, ensure_ascii=False)
-                yield f"data: {chunk_data}\n\n"
+            model_lock.acquire()
+            try:
+                for response in response_generator:
+                    chunk = StreamChoice(**response)
+                    result = ChatCompletionChunk(id=request_id, choices=[chunk])
+                    chunk_dic = result.dict(exclude_unset=True)
+                    chunk_data = json.dumps(chunk_dic, ensure_ascii=False)
+                    yield f"data: {chunk_data}\n\n"
+            finally:
+                # also reached when the stream is closed early (client disconnected)
+                response_generator.close()
+                model_lock.release()
             yield "data: [DONE]\n\n"
 
-        return StreamingResponse(get_response_stream(), media_type="text/event-stream")
+        response_stream = get_response_stream()
+        # if the client disconnects, the stream is no longer iterated, the background task
+        # still runs and closes it, so the lock is released right away instead of at garbage collection
+        return StreamingResponse(
+            response_stream,
+            media_type="text/event-stream",
+            background=BackgroundTask(response_stream.close),
+        )
 
 
 if __name__ == "__main__":
@@ -76,15 +106,69 @@ if __name__ == "__main__":
         help="choose which device to host the model: cpu, cuda, cuda:xxx, or auto",
     )
     parser.add_argument("--load_in_8bit", type=bool, default=False)
+    parser.add_argument(
+        "--load_in_4bit",
+        action="store_true",
+        help="quantize the weights to 4-bit NF4 with bitsandbytes, computing in the model dtype",
+    )
+    parser.add_argument(
+        "--attn_implementation",
+        type=str,
+        default=None,
+        choices=["eager", "sdpa", "flash_attention_2"],
+        help="attention kernel used by the model, default: flash_attention_2 if the flash-attn package is installed and the model is on GPU, sdpa otherwise",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="compile the model with torch.compile + static KV cache (requires sdpa/eager attention)",
+    )
     args = parser.parse_args()
+    # bf16 on CPU (including --device auto without GPU) and on GPUs supporting it (Ampere+), fp16 otherwise
+    torch_dtype = (
+        torch.bfloat16
+        if args.device == "cpu"
+        or not torch.cuda.is_available()
+        or torch.cuda.is_bf16_supported()
+        else torch.float16
+    )
+    attn_implementation = args.attn_implementation
+    if attn_implementation is None:
+        attn_implementation = (
+            "flash_attention_2"
+            if args.device != "cpu"
+            and is_flash_attn_2_available()
+            and not args.compile
+            else "sdpa"
+        )
+    if args.compile:
+        # fail before loading the model
+        try:
+            check_compile_support(attn_implementation)
+        except (RuntimeError, ValueError) as e:
+            parser.error(f"--compile: {e}")
+    quantization_config = None
+    if args.load_in_4bit:
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch_dtype,
+            bnb_4bit_quant_type="nf4",
+        )
+    elif args.load_in_8bit:
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
     model = AutoModelForCausalLM.from_pretrained(
         args.model,
         low_cpu_mem_usage=True,
         device_map=args.device,
-        torch_dtype=torch.bfloat16 if args.device == "cpu" else torch.float16,
-        load_in_8bit=args.load_in_8bit,
+        torch_dtype=torch_dtype,
+        quantization_config=quantization_config,
+        attn_implementation=attn_implementation,
     )
     tokenizer = LlamaTokenizerFast.from_pretrained(args.model, legacy=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
     print(tokenizer)
+    if args.compile:
+        model = compile_model_for_inference(model, tokenizer, device=model.device)
 
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,228 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+from typing import Any, List
+from unittest import mock
+
+from functionary.prompt_template import get_prompt_template_by_version
+from functionary.train import custom_datasets
+from functionary.train.custom_datasets import (
+    get_assistant_stop_token_ids,
+    get_matching_prefix,
+    get_prefix_assistant_token_ids,
+    merge_data_points_by_length,
+    read_jsonl,
+)
+from tests.utils import get_tiny_llama_tokenizer
+
+
+# get_masked_labels before it was vectorized (verbatim), used as the reference
+def get_masked_labels(
+    *,
+    input_token_ids: List[int],
+    tokenizer: Any,
+    assistant_prefix_tokens: List[List[int]],
+    assistant_stop_tokens: List[int],
+    keep_assistant_prefix: bool = False,
+    verbose: bool = False,
+):
+    """This function is used to mask labels.
+    This will retain only chunks: (prefix assistant tokens) CHUNK_TO_UNMASK (stop tokens) for computing loss
+
+    Args:
+        input_token_ids (List[int]): input_token_ids
+        tokenizer (Any): _description_
+        assistant_prefix_tokens (List[List[int]]): _description_
+        assistant_stop_tokens (List[int]): _description_
+        keep_assistant_prefix (bool, optional): _description_. Defaults to False.
+        verbose (bool, optional): _description_. Defaults to False.
+
+    Returns:
+        _type_: _description_
+    """
+    # first we initialize labels with all positions as -100,
+    # then we will fill in positions where role=assistant as we only include these in computing the loss
+    labels = [-100 for _ in range(len(input_token_ids))]
+    start = 0
+    # now we will unmask labels by positions that was from assistant
+    # we will find the chunks: "<endtoken>assistant ...(<end_of_function>|<end_of_assistant>) from input_token_ids
+    # and unmask: this part: "...(<end_of_function>|<end_of_assistant>"
+    # find token_ids of: "<endtoken>assistant"
+    # prefix_token_ids = get_prefix_assistant_token_ids(tokenizer)
+    # if verbose:
+    #    print("prefix_token_ids: ", prefix_token_ids)
+    index = 0
+    total_input_leng = len(input_token_ids)
+    while index < total_input_leng:
+        # finding the index that start with: "<endtoken>assistant" --> we will unmask labels from this position
+        matched_prefix = get_matching_prefix(
+            assistant_prefix_tokens, input_token_ids[index:]
+        )
+        if matched_prefix is not None:
+            end_index = -1
+            # unmask until reach <end_of_function> or <end_of_assistant>
+            start_masked_index = index + len(matched_prefix)
+            if keep_assistant_prefix:  # unmask prefix of assistant
+                start_masked_index = index
+
+            for i in range(start_masked_index, total_input_leng):
+                tok_id = input_token_ids[i]
+                if tok_id in assistant_stop_tokens:  # check if this is end of turn
+                    labels[i] = input_token_ids[i]  # unmask labels at this position
+                    end_index = i
+                    break
+                else:
+                    labels[i] = input_token_ids[i]  # unmask labels at this position
+
+            if verbose:
+                print("------------------------")
+                start = start_masked_index  # index + len(matched_prefix)
+                chunk_ids = (
+                    input_token_ids[start : end_index + 1]
+                    if end_index > -1
+                    else input_token_ids[start:]
+                )
+                print("chunk_ids: ", chunk_ids)
+                print(
+                    "longer chunk: ",
+                    input_token_ids[index : end_index + 1]
+                    if end_index > 1
+                    else input_token_ids[index:],
+                )
+                print(f"chunk:{tokenizer.decode(chunk_ids)}")
+                print("-------------------")
+            if (
+                end_index == -1
+            ):  # if at the end, cannot find EndToken.assistant or EndToken.function_call --> this data point was truncated
+                break
+            index = end_index
+        else:
+            index += 1
+    return labels
+
+
+class TestMaskedLabels(unittest.TestCase):
+    def assert_same_labels(self, input_token_ids: List[int], tokenizer: Any, **kwargs):
+        for keep_assistant_prefix in [False, True]:
+            self.assertEqual(
+                custom_datasets.get_masked_labels(
+                    input_token_ids=input_token_ids,
+                    tokenizer=tokenizer,
+                    keep_assistant_prefix=keep_assistant_prefix,
+                    **kwargs,
+                ),
+                get_masked_labels(
+                    input_token_ids=input_token_ids,
+                    tokenizer=tokenizer,
+                    keep_assistant_prefix=keep_assistant_prefix,
+                    **kwargs,
+                ),
+                f"different labels for: {input_token_ids}, keep_assistant_prefix={keep_assistant_prefix}",
+            )
+
+    def test_random_token_ids(self):
+        # overlapping prefixes, prefixes inside unmasked chunks and truncated chunks (no stop token)
+        rng = random.Random(0)
+        for _ in range(2000):
+            input_token_ids = [rng.randint(0, 10) for _ in range(rng.randint(0, 40))]
+            self.assert_same_labels(
+                input_token_ids,
+                None,
+                assistant_prefix_tokens=[[1, 2], [1, 2, 3], [5]],
+                assistant_stop_tokens=[9, 8],
+            )
+
+    def test_prompt_templates(self):
+        current_folder = os.path.dirname(os.path.abspath(__file__))
+        for template_version in ["v1", "v2"]:
+            prompt_template = get_prompt_template_by_version(template_version)
+            with open(os.path.join(current_folder, f"test_case_{template_version}.json")) as f:
+                test_case = json.loads(f.read())
+            tools_or_functions = (
+                test_case["tools"] if "tools" in test_case else test_case["functions"]
+            )
+            prompt_str = prompt_template.get_prompt_from_messages(
+                test_case["messages"], tools_or_functions
+            )
+
+            tokenizer = get_tiny_llama_tokenizer()
+            tokenizer.add_special_tokens(
+                {"additional_special_tokens": prompt_template.get_additional_tokens()}
+            )
+            assistant_prefix_tokens = get_prefix_assistant_token_ids(
+                prompt_template, tokenizer
+            )
+            assistant_stop_tokens = get_assistant_stop_token_ids(
+                prompt_template, tokenizer
+            )
+            input_token_ids = tokenizer(prompt_str)["input_ids"]
+            # check that the test case has assistant chunks to unmask
+            labels = get_masked_labels(
+                input_token_ids=input_token_ids,
+                tokenizer=tokenizer,
+                assistant_prefix_tokens=assistant_prefix_tokens,
+                assistant_stop_tokens=assistant_stop_tokens,
+            )
+            self.assertTrue(any(label != -100 for label in labels))
+
+            # the full prompt and a truncated one that ends inside an assistant message
+            for token_ids in [input_token_ids, input_token_ids[:-3]]:
+                self.assert_same_labels(
+                    token_ids,
+                    tokenizer,
+                    assistant_prefix_tokens=assistant_prefix_tokens,
+                    assistant_stop_tokens=assistant_stop_tokens,
+                )
+
+
+class TestMergeDataPointsByLength(unittest.TestCase):
+    def test_groups(self):
+        rng = random.Random(0)
+        for max_length in [1, 16, 100, 4096]:
+            for size in [0, 1, 7, 500]:
+                lengths = [rng.randint(1, max_length) for _ in range(size)]
+                groups = merge_data_points_by_length(lengths, max_length)
+                for group in groups:
+                    self.assertGreater(len(group), 0, "empty group")
+                    self.assertLessEqual(
+                        sum(lengths[index] for index in group),
+                        max_length,
+                        f"group exceeds pack_length: {group}",
+                    )
+                # every index is kept exactly once
+                self.assertEqual(
+                    sorted(index for group in groups for index in group),
+                    list(range(size)),
+                )
+
+
+class TestReadJsonl(unittest.TestCase):
+    def test_orjson_and_json(self):
+        items = [
+            {"messages": [{"role": "user", "content": "Xin chào 👋"}], "functions": []},
+            {"a": 1, "b": 2.5, "c": None, "d": True, "e": [1, [2, {"f": "g"}]]},
+            {"text": "quotes \" and \\ backslash\nnew line"},
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "data.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                # blank lines are skipped, the last line has no newline
+                f.write(json.dumps(items[0]) + "\n\n")
+                f.write(json.dumps(items[1], ensure_ascii=False) + "\r\n")
+                f.write(json.dumps(items[2], ensure_ascii=False))
+
+            # the reader before orjson
+            with open(path, "r", encoding="utf-8") as f:
+                expected = [json.loads(line) for line in f if line.strip()]
+            self.assertEqual(expected, items)
+
+            # orjson if it is installed, else json
+            self.assertEqual(read_jsonl(path), expected)
+            with mock.patch.object(custom_datasets, "orjson", None):
+                self.assertEqual(read_jsonl(path), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
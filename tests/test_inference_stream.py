@@ -0,0 +1,56 @@
+import unittest
+
+from functionary.inference_stream import decode_incrementally
+from tests.utils import get_tiny_llama_tokenizer
+
+
+class TestDecodeIncrementally(unittest.TestCase):
+    def test_match_full_decode(self):
+        texts = [
+            "Hello world, this is a simple sentence.",
+            "  leading and   multiple   spaces\n\n  and new lines  ",
+            "Xin chào thế giới, 東京は晴れ, привет мир",
+            "emoji 👋🏽 and 🇻🇳 flags, then text again",
+            '{"name": "get_weather", "arguments": {"city": "São Paulo"}}',
+        ]
+        tokenizer = get_tiny_llama_tokenizer()
+        prompt_ids = tokenizer.encode("user:\nhi\nassistant:")
+        prompt_text = tokenizer.decode(
+            prompt_ids, skip_special_tokens=False, clean_up_tokenization_spaces=False
+        )
+        for text in texts:
+            generated_ids = tokenizer.encode(text, add_special_tokens=False)
+            full_text = tokenizer.decode(
+                prompt_ids + generated_ids,
+                skip_special_tokens=False,
+                clean_up_tokenization_spaces=False,
+            )
+            # small windows move the context forward several times
+            for max_window in [2, 4, 16]:
+                # the same offsets as in generate_text_stream
+                all_token_ids = list(prompt_ids)
+                read_offset = len(all_token_ids)
+                prefix_offset = max(read_offset - 5, 0)
+                prefix_text = None
+                outputs = []
+                for token_id in generated_ids:
+                    all_token_ids.append(token_id)
+                    output, prefix_offset, read_offset, prefix_text = decode_incrementally(
+                        tokenizer,
+                        all_token_ids,
+                        prefix_offset,
+                        read_offset,
+                        prefix_text,
+                        max_window=max_window,
+                    )
+                    self.assertNotIn("\ufffd", output, "incomplete multi-byte character")
+                    outputs.append(output)
+                self.assertEqual(
+                    "".join(outputs),
+                    full_text[len(prompt_text) :],
+                    f"text: {text}, max_window={max_window}",
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import os
+
+from tokenizers import (
+    Tokenizer,
+    decoders,
+    models,
+    normalizers,
+    pre_tokenizers,
+    trainers,
+)
+from transformers import LlamaTokenizerFast
+
+
+def get_tiny_llama_tokenizer(vocab_size: int = 600) -> LlamaTokenizerFast:
+    """Build a small Llama-like tokenizer offline, trained on the prompts in the tests folder.
+    Like the Llama tokenizer, it is a BPE with "▁" for spaces, a leading space removed in decoding
+    and byte fallback (<0x00> ... <0xFF>) for the characters not in the vocab (all non-ASCII characters here)
+
+    Args:
+        vocab_size (int, optional): size of the trained vocab, before adding the byte tokens. Defaults to 600.
+
+    Returns:
+        LlamaTokenizerFast: the tokenizer
+    """
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+    corpus = []
+    for file_name in ["prompt_test_v1.txt", "prompt_test_v2.txt"]:
+        with open(os.path.join(current_folder, file_name)) as f:
+            corpus.append(f.read())
+
+    special_tokens = ["<unk>", "<s>", "</s>"]
+    # as in the Llama tokenizer, "▁" is prepended to the text between special tokens and replaces the spaces;
+    # the merges are kept inside the words and new lines are separate tokens
+    normalizer = normalizers.Sequence(
+        [normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")]
+    )
+    pre_tokenizer = pre_tokenizers.Sequence(
+        [
+            pre_tokenizers.Split("\n", behavior="isolated"),
+            pre_tokenizers.Split("▁", behavior="merged_with_next"),
+        ]
+    )
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.normalizer = normalizer
+    tokenizer.pre_tokenizer = pre_tokenizer
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size, special_tokens=special_tokens, show_progress=False
+    )
+    tokenizer.train_from_iterator(corpus, trainer=trainer)
+
+    # same layout as Llama: special tokens, then the 256 byte tokens, then the trained tokens
+    trained = json.loads(tokenizer.to_str())["model"]
+    vocab = {token: index for index, token in enumerate(special_tokens)}
+    for byte in range(256):
+        vocab[f"<0x{byte:02X}>"] = len(vocab)
+    for token, _ in sorted(trained["vocab"].items(), key=lambda item: item[1]):
+        if token not in vocab:
+            vocab[token] = len(vocab)
+    merges = [
+        tuple(merge.split(" ")) if isinstance(merge, str) else tuple(merge)
+        for merge in trained["merges"]
+    ]
+
+    tokenizer = Tokenizer(
+        models.BPE(
+            vocab=vocab,
+            merges=merges,
+            unk_token="<unk>",
+            byte_fallback=True,
+            fuse_unk=True,
+        )
+    )
+    tokenizer.normalizer = normalizer
+    tokenizer.pre_tokenizer = pre_tokenizer
+    tokenizer.decoder = decoders.Sequence(
+        [
+            decoders.Replace("▁", " "),
+            decoders.ByteFallback(),
+            decoders.Fuse(),
+            decoders.Strip(content=" ", left=1, right=0),
+        ]
+    )
+    tokenizer = LlamaTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>",
+        legacy=True,
+    )
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer